@@ -0,0 +1,178 @@
+from collections import Counter
+from pathlib import Path
+from typing import Iterable
+import atexit
+import json
+import shutil
+import threading
+import time
+
+from file_utils import atomic_write
+
+
+def dir_size(path: Path) -> int:
+    if not path.exists():
+        return 0
+    return sum(file.stat().st_size for file in path.rglob('*') if file.is_file())
+
+
+class AlbumCache:
+    '''
+    JM_ROOT下本子缓存的索引，每个本子的大小与最后访问时间记在索引文件中，不用每次遍历整个目录树
+    总大小超过quota字节时，按最久没访问的顺序删除本子目录（包括混淆后的图片）以及它在zip_root下的压缩包
+    正在发送的本子用pin标记，清理时跳过
+    索引的修改先记在内存里，最多save_interval秒写一次文件
+    '''
+    INDEX_NAME = '.cache_index.json'
+
+    def __init__(self, root: Path, quota: int, zip_root: Path | None = None, save_interval: float = 10.0) -> None:
+        self.root = root
+        self.quota = quota
+        self.zip_root = zip_root
+        self.save_interval = save_interval
+        self._lock = threading.RLock()
+        self._index: dict[str, dict[str, float]] = {}  # album_id -> {'size': 字节数, 'last_access': 时间戳}
+        self._pins: Counter[str] = Counter()  # album_id -> 正在使用它的请求数
+        self._dirty = False
+        self._timer: threading.Timer | None = None
+        try:
+            self._index = json.loads((root / self.INDEX_NAME).read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            # 没有索引时扫描一次已有的本子，之后只按本子增量更新
+            self._reconcile()
+            self.flush()
+        atexit.register(self.flush)
+
+    def _album_dirs(self) -> list[Path]:
+        if not self.root.is_dir():
+            return []
+        return [d for d in self.root.iterdir() if d.is_dir() and not d.name.startswith('.')]
+
+    def _reconcile(self) -> None:
+        '''
+        让索引与目录一致：补上没有记录的本子（例如下载失败或部分失败留下的目录），去掉已经不存在的
+        只统计新出现的本子的大小
+        '''
+        with self._lock:
+            albums = {d.name: d for d in self._album_dirs()}
+            for album_id in self._index.keys() - albums.keys():
+                del self._index[album_id]
+                self._dirty = True
+            for album_id in albums.keys() - self._index.keys():
+                self._index[album_id] = {
+                    'size': self.measure(album_id),
+                    'last_access': albums[album_id].stat().st_mtime,
+                }
+                self._dirty = True
+
+    def _save(self) -> None:
+        with atomic_write(self.root / self.INDEX_NAME) as tmp_path:
+            tmp_path.write_text(json.dumps(self._index), encoding='utf-8')
+
+    def _mark_dirty(self) -> None:
+        self._dirty = True
+        if self._timer is None:
+            self._timer = threading.Timer(self.save_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self) -> None:
+        '''
+        把内存中的修改写入索引文件
+        '''
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            self._save()
+            self._dirty = False
+
+    def measure(self, album_id: str) -> int:
+        '''
+        只遍历这一个本子的目录（以及它的压缩包目录）
+        '''
+        size = dir_size(self.root / album_id)
+        if self.zip_root is not None:
+            size += dir_size(self.zip_root / album_id)
+        return size
+
+    def touch(self, album_id: str, measure: bool = False) -> None:
+        '''
+        记录一次访问，measure为True时重新统计该本子的大小（下载或生成混淆图片之后）
+        '''
+        with self._lock:
+            entry = self._index.setdefault(album_id, {'size': 0, 'last_access': 0})
+            entry['last_access'] = time.time()
+            if measure:
+                entry['size'] = self.measure(album_id)
+            self._mark_dirty()
+
+    def pin(self, album_id: str) -> None:
+        '''
+        标记本子正在使用，unpin之前不会被清理，可以嵌套
+        '''
+        with self._lock:
+            self._pins[album_id] += 1
+
+    def unpin(self, album_id: str, delay: float = 0.0) -> None:
+        '''
+        delay秒后取消一次pin，用于等待发送队列里的消息发完
+        '''
+        if delay > 0:
+            timer = threading.Timer(delay, self.unpin, args=(album_id,))
+            timer.daemon = True
+            timer.start()
+            return
+        with self._lock:
+            self._pins[album_id] -= 1
+            if self._pins[album_id] <= 0:
+                del self._pins[album_id]
+
+    def forget(self, album_id: str | None = None) -> None:
+        '''
+        本子被手动删除后调用，album_id为None表示全部删除
+        '''
+        with self._lock:
+            if album_id is None:
+                self._index.clear()
+            else:
+                self._index.pop(album_id, None)
+            self._dirty = True
+            self.flush()
+
+    def total(self) -> int:
+        with self._lock:
+            return int(sum(entry['size'] for entry in self._index.values()))
+
+    def evict(self, keep: Iterable[str] = ()) -> list[str]:
+        '''
+        删除最久没访问的本子直到总大小不超过quota，keep中的与被pin的本子不会被删除，返回被删除的本子
+        '''
+        keep = set(keep)
+        evicted: list[str] = []
+        with self._lock:
+            self._reconcile()
+            total = self.total()
+            for album_id, entry in sorted(self._index.items(), key=lambda item: item[1]['last_access']):
+                if total <= self.quota:
+                    break
+                if album_id in keep or album_id in self._pins:
+                    continue
+                shutil.rmtree(self.root / album_id, ignore_errors=True)
+                if self.zip_root is not None:
+                    shutil.rmtree(self.zip_root / album_id, ignore_errors=True)
+                total -= int(entry['size'])
+                evicted.append(album_id)
+            for album_id in evicted:
+                del self._index[album_id]
+            if evicted:
+                self._dirty = True
+            self.flush()
+        return evicted
+
+    def evict_in_background(self, keep: Iterable[str] = ()) -> threading.Thread:
+        thread = threading.Thread(target=self.evict, args=(tuple(keep),), name='album-cache-evict', daemon=True)
+        thread.start()
+        return thread
@@ -1,4 +1,24 @@
-from typing import Any, Callable
+from typing import Any, AsyncGenerator, Callable, Iterator
+import asyncio
+import inspect
+
+
+def iter_async[T](agen: AsyncGenerator[T, None]) -> Iterator[T]:
+    '''
+    在一个新的事件循环中逐项驱动异步生成器，供同步的for使用
+    提前停止迭代时也会关闭异步生成器，执行它的finally
+    生成器结束后关闭事件循环，尚未到期的call_later回调不会再执行
+    '''
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(anext(agen))
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(agen.aclose())
+        loop.close()
 
 
 class CommandExecutor(dict):
@@ -24,7 +44,11 @@ class CommandExecutor(dict):
         args = self[command_name]['parser'](args_str)
         if not isinstance(args, list):
             args = (args,)
-        return self[command_name]['generator'](context, *args)    
+        result = self[command_name]['generator'](context, *args)
+        if inspect.isasyncgen(result):
+            # 异步指令（例如/jm）转成同步生成器，调用方统一用for消费
+            return iter_async(result)
+        return result
     
     def register(self, command_name: str | None = None, parser: Callable[[str], Any] | None = None):
         '''
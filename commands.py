@@ -7,7 +7,6 @@ import string
 import random
 import time
 
-import pyzipper
 import jmcomic
 import cv2
 import shutil
@@ -16,6 +15,7 @@ import json
 from jmcomic import download_album
 from yaml import safe_load, safe_dump
 import numpy as np
+import asyncio
 
 from ncatbot.core.helper.forward_constructor import ForwardConstructor
 from ncatbot.core import MessageArray
@@ -25,7 +25,9 @@ from ncatbot.core.event.message_segment import (
 )
 
 from command_executor import CommandExecutor
-from cv_utils import obfuscation
+from cv_utils import iter_obfuscate_album, ObfuscationManifest
+from zip_utils import submit_aes_zip, remove_stale
+from cache_utils import AlbumCache
 
 
 config: dict = safe_load(Path('hirasawa_config.yaml').read_text())
@@ -34,6 +36,10 @@ option = jmcomic.create_option_by_file('./jm_option.yml')
 commands = CommandExecutor()
 
 JM_ROOT: Path = Path() / config['jm_root']
+JM_ZIP_ROOT: Path = JM_ROOT / '.zips'  # -z生成的压缩包，按本子分目录，上传后延迟删除
+JM_ZIP_TTL: float = config.get('jm_zip_ttl', 600)  # 压缩包交给发送方之后保留的秒数，等上传完成
+# 本子缓存超过jm_quota（MB）时删除最久没看的本子
+album_cache = AlbumCache(JM_ROOT, quota=config.get('jm_quota', 4096) * 1024 * 1024, zip_root=JM_ZIP_ROOT)
 ADMIN_ID = config['admin_id']  # 管理员 QQ 号
 BOT_ID = config['bot_id']  # 机器人 QQ 号
 ECCHI_GROUPS = config['ecchi_groups']
@@ -76,7 +82,7 @@ def echo(context, *args):
 
 
 @commands.register()
-def jm(context, *args: str):
+async def jm(context, *args: str):
     '''
     输入禁漫编号，下载该漫画
     并将本子哈希混淆后发到群里
@@ -92,7 +98,6 @@ def jm(context, *args: str):
         yield "请联系bot主人将本群加入色色名单"
         return
     jm_album_id = args[-1]
-    doujinshi_dir = JM_ROOT / jm_album_id
     if '-c' in args and context['sender_id'] != ADMIN_ID:
         yield "你没有权限执行此命令！"
         return
@@ -103,12 +108,30 @@ def jm(context, *args: str):
                 shutil.rmtree(d, ignore_errors=True)
             else:
                 d.unlink()
+        album_cache.forget()
         yield "缓存清理完毕"
         return
+    # 下载与发送期间不能被其他请求的清理删掉
+    # yield返回时消息可能还在发送队列里，过JM_ZIP_TTL秒再取消
+    album_cache.pin(jm_album_id)
+    try:
+        async for message in _serve_album(args, jm_album_id):
+            yield message
+    finally:
+        album_cache.unpin(jm_album_id, delay=JM_ZIP_TTL)
+
+
+async def _serve_album(args: tuple[str, ...], jm_album_id: str):
+    '''
+    jm的下载、打包与发送部分，调用方负责pin住该本子
+    '''
+    doujinshi_dir = JM_ROOT / jm_album_id
     if (doujinshi_dir / 'info.yaml').exists():
         if '-c' in args:
             yield "开始清理缓存…"
             shutil.rmtree(doujinshi_dir, ignore_errors=True)
+            shutil.rmtree(JM_ZIP_ROOT / jm_album_id, ignore_errors=True)
+            album_cache.forget(jm_album_id)
             yield "缓存清理完毕"
             return
         yield "本子已存在"
@@ -119,7 +142,7 @@ def jm(context, *args: str):
             yield "未下载该本子，请检查编号是否正确"
             return
         try:
-            detail, _ = download_album(jm_album_id, option=option)
+            detail, _ = await asyncio.to_thread(download_album, jm_album_id, option=option)
         except jmcomic.jm_exception.PartialDownloadFailedException as e:
             yield "部分下载失败，将仅上传成功下载的部分"
             yield f"失败原因：{str(e)}"
@@ -135,6 +158,7 @@ def jm(context, *args: str):
             'tags': detail.tags
         }
         safe_dump(info, (doujinshi_dir / 'info.yaml').open('w', encoding='utf-8'))
+    album_cache.touch(jm_album_id)
     ans = ""
     ans += f'本子名称：{info["name"]}\n'
     ans += f'漫画作者：{"+".join(info["authors"])}\n'
@@ -145,34 +169,83 @@ def jm(context, *args: str):
         all_chars = string.ascii_letters + string.digits
         password = ''.join(random.choices(all_chars, k=8))
         zip_name = f'密码: "{password}" {info["name"]}.zip'
-        zipf = pyzipper.AESZipFile(zip_name,'w', compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES)
         yield f'本子解压缩密码："{password}"'
-        zipf.setpassword(password.encode('utf-8')) 
-        for file in doujinshi_dir.iterdir():
-            if file.is_dir(): continue
-            zipf.write(str(file))
-        zipf.close()
+        # 只打包原图与本子信息，不包括混淆后的图片
+        files = [
+            file for file in sorted(doujinshi_dir.iterdir())
+            if file.is_file()
+            and not file.name.startswith('obfuscated')
+        ]
+        zip_path = JM_ZIP_ROOT / jm_album_id / zip_name
+        zipped = 0
+        def on_progress(done: int, total: int):
+            nonlocal zipped
+            zipped = done
+        # 上次运行遗留的、早就上传完的压缩包
+        remove_stale(JM_ZIP_ROOT, JM_ZIP_TTL)
+        # 在工作线程中压缩，不阻塞事件循环，每15秒汇报一次进度
+        future = asyncio.wrap_future(submit_aes_zip(zip_path, files, password.encode('utf-8'), progress=on_progress))
+        while True:
+            try:
+                # shield: 超时只是为了汇报进度，不能取消压缩
+                await asyncio.wait_for(asyncio.shield(future), timeout=15)
+                break
+            except TimeoutError:
+                yield f'少女压缩中… {zipped}/{len(files)}'
+            except Exception as e:
+                yield '少女压缩失败T_T'
+                yield f'失败原因：{type(e).__name__}: {e}'
+                return
         yield '少女上传压缩包中…'
-        yield JM_ROOT / zip_name
+        try:
+            yield zip_path
+        finally:
+            # 每次请求的密码都不同，压缩包没有复用的价值
+            # yield返回时消息可能还在发送队列里，过JM_ZIP_TTL秒再删除
+            asyncio.get_running_loop().call_later(JM_ZIP_TTL, zip_path.unlink, True)
     else:
         fcr = ForwardConstructor(user_id=BOT_ID, nickname="HirasawaBot")
         fcr.attach(MessageArray(Text(ans)))
-        for img_path in doujinshi_dir.iterdir():
-            if not img_path.is_file(): continue
-            if img_path.suffix not in ['.jpg', '.png', '.webp']: continue
-            if img_path.name.startswith('obfuscated_'): continue
-            print(img_path.name)
-            obfuscated_img_path = doujinshi_dir / f'obfuscated_{img_path.stem}.jpg'
-            img = cv2.imread(str(img_path.absolute()))
-            if img is None:
+        images = [
+            img_path
+            for img_path in sorted(doujinshi_dir.iterdir())
+            if img_path.is_file()
+            and img_path.suffix in ['.jpg', '.png', '.webp']
+            and not img_path.name.startswith('obfuscated_')
+        ]
+        # 混淆结果按种子缓存，jm_seed_rotation（小时）不为0时定期更换种子
+        rotation = config.get('jm_seed_rotation', 0)
+        manifest = ObfuscationManifest(
+            doujinshi_dir,
+            jm_album_id,
+            rotate_every=rotation * 3600 if rotation else None,
+            salt=str(config.get('jm_seed_salt', '')),
+        )
+        pages = manifest.pending(images)
+        # 多进程并行混淆，大约每处理完1/5汇报一次进度
+        step = max(1, len(pages) // 5)
+        # 等待进程池结果的next()放到线程里，不阻塞事件循环
+        results = iter_obfuscate_album(pages, seed=manifest.seed)
+        done = 0
+        while (result := await asyncio.to_thread(next, results, None)) is not None:
+            index, ok = result
+            done += 1
+            if ok:
+                manifest.done(pages[index][0])
+            if done % step == 0 and done != len(pages):
+                yield f'已处理 {done}/{len(pages)} 页'
+        manifest.save()
+        for img_path in images:
+            if not manifest.is_done(img_path):
                 fcr.attach(MessageArray(Text(f'无法读取{img_path.name}，请检查文件格式')))
                 continue
-            obfuscated_img = obfuscation(img)
-            cv2.imwrite(str(obfuscated_img_path.absolute()), obfuscated_img)
-            fcr.attach(MessageArray(Image(file=str(obfuscated_img_path.absolute()))))
+            fcr.attach(MessageArray(Image(file=str(manifest.output_path(img_path).absolute()))))
         fcr.attach(MessageArray(Text(f'图片已经过哈希混淆，如果需要下载本子原图，请使用"/jm -z {jm_album_id}"，然根据提示下载并解压')))
         yield '少女上传QQ合并消息中…'
         yield fcr.to_forward()
+    # 混淆后的图片也计入大小，超出配额时在后台删除最久没看的本子
+    album_cache.touch(jm_album_id, measure=True)
+    album_cache.evict_in_background()
     yield "请欣赏本子吧！"
     
 
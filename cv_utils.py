@@ -1,35 +1,147 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterator, Sequence
+import hashlib
+import json
+import os
+import time
+import zlib
+
 import cv2
 from cv2.typing import MatLike
 
 import numpy as np
-import random
+
+from file_utils import atomic_write
+
+
+def perturb(img: MatLike, rng: np.random.Generator) -> MatLike:
+    '''
+    随机选取pixel_num // 32个像素，替换成上下左右四个像素的平均值加上[-25, 25)的噪声
+    一次性采样全部坐标并用数组索引计算，求和时用int16避免uint8溢出
+    '''
+    w, h, c = img.shape
+    img = img.copy()
+    num = w * h // 32
+    if num == 0 or w < 3 or h < 3:
+        return img
+    p_w = rng.integers(1, w - 1, num)
+    p_h = rng.integers(1, h - 1, num)
+    src = img.astype(np.int16, copy=False)
+    average = (src[p_w + 1, p_h] + src[p_w - 1, p_h] + src[p_w, p_h + 1] + src[p_w, p_h - 1]) // 4
+    noise = rng.integers(-25, 25, (num, c), dtype=np.int16)
+    img[p_w, p_h] = np.clip(average + noise, 0, 255).astype(np.uint8)
+    return img
 
 
-def obfuscation(img: MatLike) -> MatLike:
+def obfuscation(img: MatLike, rng: np.random.Generator | int | None = None) -> MatLike:
+    '''
+    随机翻转、扰动部分像素，再放到一张长宽各大1/4的随机噪声图中的随机位置
+    rng可以传入种子或np.random.Generator，相同的种子得到相同的结果
+    '''
+    rng = np.random.default_rng(rng)
     w, h, c = img.shape
     new_w = w * 5 // 4
     new_h = h * 5 // 4
     diff_w = new_w - w
     diff_h = new_h - h
-    w_start = random.randint(0, diff_w)
-    h_start = random.randint(0, diff_h)
-    pixel_num = w * h
-    choice = random.randint(0, 1)
-    if choice == 0:
+    w_start = rng.integers(0, diff_w, endpoint=True)
+    h_start = rng.integers(0, diff_h, endpoint=True)
+    if rng.integers(0, 2) == 0:
         img = cv2.flip(img, 0)
-    choice = random.randint(0, 1)
-    if choice == 0:
+    if rng.integers(0, 2) == 0:
         img = cv2.flip(img, 1)
-    for _ in range(pixel_num // 32):
-        noise = np.random.randint(-25, 25, (c,), dtype=np.int8)
-        p_w = random.randint(1, w-2)
-        p_h = random.randint(1, h-2)
-        img[p_w, p_h] = (img[p_w+1, p_h] + img[p_w-1, p_h] + img[p_w, p_h+1] + img[p_w, p_h-1]) // 4 + noise
-    new_img = np.random.randint(0, 256, (new_w, new_h, c), dtype=np.uint8)
+    img = perturb(img, rng)
+    new_img = rng.integers(0, 256, (new_w, new_h, c), dtype=np.uint8)
     new_img[w_start:w_start+w, h_start:h_start+h] = img
     return new_img
 
 
+def obfuscate_file(src: Path, dst: Path, seed: np.random.SeedSequence | int | None = None) -> bool:
+    '''
+    读取src，混淆后写入dst，读取失败返回False
+    作为进程池的任务函数，必须定义在模块顶层
+    '''
+    img = cv2.imread(str(src))
+    if img is None:
+        return False
+    return cv2.imwrite(str(dst), obfuscation(img, np.random.default_rng(seed)))
+
+
+def iter_obfuscate_album(
+    pages: Sequence[tuple[Path, Path]],
+    seed: int | None = None,
+    max_workers: int | None = None,
+) -> Iterator[tuple[int, bool]]:
+    '''
+    用进程池并行混淆整本漫画，pages为(原图, 输出路径)列表
+    每处理完一页yield一次(页码下标, 是否成功)，顺序为完成顺序而不是页码顺序，
+    调用方可以借此汇报进度，并按下标把结果放回原来的顺序
+    给定seed时每页的结果只由(seed, 原图文件名)决定，与页的顺序和数量无关
+    '''
+    if len(pages) == 0:
+        return
+    # 每页一个独立的随机数流
+    if seed is None:
+        seeds = np.random.SeedSequence().spawn(len(pages))
+    else:
+        seeds = [np.random.SeedSequence([seed, zlib.crc32(src.name.encode('utf-8'))]) for src, _ in pages]
+    workers = min(max_workers or os.cpu_count() or 1, len(pages))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(obfuscate_file, src, dst, page_seed): index
+            for index, ((src, dst), page_seed) in enumerate(zip(pages, seeds))
+        }
+        for future in as_completed(futures):
+            try:
+                ok = future.result()
+            except Exception:
+                ok = False
+            yield futures[future], ok
+
+
+class ObfuscationManifest:
+    '''
+    把本子目录下混淆后的图片当作缓存，manifest记录当前种子与已完成的页
+    同一本子、同一页、同一种子的混淆结果是确定的，重复请求只处理新增或原图有变化的页
+    rotate_every（秒）不为None时种子定期轮换，轮换后之前的缓存全部作废
+    '''
+    FILE_NAME = 'obfuscated.json'
+
+    def __init__(self, album_dir: Path, album_id: str, rotate_every: float | None = None, salt: str = '') -> None:
+        self.album_dir = album_dir
+        self.epoch = int(time.time() // rotate_every) if rotate_every else 0
+        digest = hashlib.sha256(f'{salt}:{album_id}:{self.epoch}'.encode('utf-8')).digest()
+        self.seed = int.from_bytes(digest[:8], 'little')
+        self._pages: dict[str, int] = {}  # 原图文件名 -> 处理时原图的mtime
+        try:
+            manifest = json.loads((album_dir / self.FILE_NAME).read_text(encoding='utf-8'))
+            if manifest['seed'] == self.seed:
+                self._pages = dict(manifest['pages'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def output_path(self, src: Path) -> Path:
+        return self.album_dir / f'obfuscated_{src.stem}.jpg'
+
+    def is_done(self, src: Path) -> bool:
+        mtime = self._pages.get(src.name)
+        return mtime is not None and mtime == src.stat().st_mtime_ns and self.output_path(src).exists()
+
+    def pending(self, pages: Sequence[Path]) -> list[tuple[Path, Path]]:
+        '''
+        返回还需要处理的(原图, 输出路径)列表
+        '''
+        return [(src, self.output_path(src)) for src in pages if not self.is_done(src)]
+
+    def done(self, src: Path) -> None:
+        self._pages[src.name] = src.stat().st_mtime_ns
+
+    def save(self) -> None:
+        with atomic_write(self.album_dir / self.FILE_NAME) as tmp_path:
+            tmp_path.write_text(json.dumps({'seed': self.seed, 'epoch': self.epoch, 'pages': self._pages}), encoding='utf-8')
+
+
 if __name__ == '__main__':
     img = cv2.imread('test.png')
     if img is None:
@@ -0,0 +1,26 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+import os
+import threading
+
+
+@contextmanager
+def atomic_write(path: Path, suffix: str = '.tmp') -> Iterator[Path]:
+    '''
+    先写入同目录下的临时文件，with块正常结束后再用os.replace替换path，
+    进程中途退出或写入出错时不会留下写了一半的path，临时文件也会被删除
+    临时文件名为path的文件名加上进程号、线程号与suffix，
+    需要按扩展名决定格式时（例如Pillow的save）可以传入'.tmp.png'
+    ```python
+    with atomic_write(path) as tmp_path:
+        tmp_path.write_text(text)
+    ```
+    '''
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}{suffix}')
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
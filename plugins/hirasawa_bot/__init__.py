@@ -1,15 +1,15 @@
 from functools import wraps
-from itertools import chain, batched, takewhile
 from pathlib import Path
 
-from pypinyin import pinyin, Style
+from pypinyin import Style
 import yaml  # type: ignore
 import openai
 import time
+import math
 import json
 import random
 import asyncio
-from typing import Iterator
+from typing import Iterator, Iterable, Sequence
 
 
 from ncatbot.plugin_system import (
@@ -37,7 +37,11 @@ from ncatbot.plugin_system.builtin_plugin.unified_registry.command_system.utils.
 
 from .bot_utils import *
 from .isaac_utis import *
-from .ai_utils import HirasawaAI
+from .ai_utils import HirasawaAsyncAI, AIRouter, AIResponseError, ProviderUnavailable, ResponseCache, SingleFlight
+from .ratelimit_utils import RateLimiter, RateLimitExceeded, BucketConfig
+from .history_utils import ChatRecord, GroupHistory, Streak, HistoryStore, HistoryArchive, CompactHistory, compact_history, conversation_anchor
+from .trigger_utils import TriggerEngine
+from .reaction_utils import ReactionEngine, Cost, reaction, reaction_input
 from .falsifysignature import flatten_args, flatten_kwargs
 
 
@@ -63,23 +67,92 @@ class HirasawaBot(NcatBotPlugin):
         self.ISAAC_COLLECTIBLES: Path = self.ISAAC_ROOT / 'items' / 'collectibles'
         self.ISAAC_TRINKETS: Path = self.ISAAC_ROOT / 'items' / 'trinkets'
         self.ISAAC_EID: Path = self.ISAAC_ROOT / 'eid'
-        self.lang = 'zh_cn'  # 暂时硬编码
-        self.isaac_collectibles = load_eid('collectibles', self.ISAAC_ROOT, self.lang)
-        self.isaac_trinkets = load_eid('trinkets', self.ISAAC_ROOT, self.lang)
+        # isaac_lang: {default: zh_cn, fallback: {en_us: [zh_cn]}, groups: {群号: en_us}, max_packs: 2}
+        isaac_lang: dict = config.get('isaac_lang', {})
+        self.isaac = EIDLibrary(
+            self.ISAAC_ROOT,
+            default_lang=isaac_lang.get('default', 'zh_cn'),
+            fallback=isaac_lang.get('fallback', {}),
+            max_packs=isaac_lang.get('max_packs', 2),
+        )
+        self._isaac_group_lang: dict[str, str] = {
+            str(group_id): lang for group_id, lang in isaac_lang.get('groups', {}).items()
+        }
+        self.isaac_icons = IconIndex(self.ISAAC_ROOT)
+        # isaac_card: {font: 字体文件（相对于isaac_root，不填则使用系统中文字体）, width: 640, font_size: 22, max_cards: 1024}
+        # 不配置则不渲染卡片
+        card_config: dict | None = config.get('isaac_card')
+        self.isaac_cards: EIDCardRenderer | None = None
+        if card_config is not None and card_config.get('enabled', True):
+            font = card_config.get('font')
+            self.isaac_cards = EIDCardRenderer(
+                self.ISAAC_ROOT / '.cache' / 'cards',
+                font=self.ISAAC_ROOT / font if font else None,
+                width=card_config.get('width', 640),
+                font_size=card_config.get('font_size', 22),
+                max_cards=card_config.get('max_cards', 1024),
+            )
+        self.ISAAC_CANDIDATES: int = config.get('isaac_candidates', 5)
         self.ADMIN_ID = config['admin_id']
         self.BOT_ID = config['bot_id']
         self.MAX_HISTORY = config['max_history']
         self.POP_FREQ = config['pop_freq']
         self.TEST_GROUP = config['test_group']
+        self.outbound_interval: float = config.get('send_interval', 0.5)
+        self.outbound = OutboundQueue(
+            self,
+            interval=self.outbound_interval,
+            window=config.get('coalesce_window', 0.2),
+        )
+        self.history = HistoryStore(self.MAX_HISTORY, bot_id=str(self.BOT_ID))
+        # 复读阈值，可以按群覆盖：streak: {repeat: 3, formation: 3, groups: {群号: {repeat: 5}}}
+        self._streak_config: dict = config.get('streak', {})
+        self._streak_groups: dict[str, dict] = {
+            str(group_id): group_config or {}
+            for group_id, group_config in self._streak_config.get('groups', {}).items()
+        }
+        self.triggers = TriggerEngine()
+        self.triggers.add('heyiwei', 'he yi wei')
+        self.triggers.add('caicaibei', 'c c b', Style.FIRST_LETTER)
+        self.reactions = ReactionEngine(self)
+        self._pop_jobs: dict[str, asyncio.Task] = {}
+        self._pop_delay: float = config.get('pop_delay', 20.0)
+        self.archive = HistoryArchive(self.workspace / config.get('history_archive', 'history.sqlite3'))
+        # 从归档中恢复聊天记录，这些群不再需要调用NapCat的历史记录接口
+        for group_id in await self.archive.groups():
+            self.history[group_id].bootstrap(await self.archive.recent(group_id, self.MAX_HISTORY))
         self.promts = load_prompts(self.workspace / config['prompts_root'])
         ai_config = config['ai']
-        provider = ai_config['providers'][ai_config['provider']]
-        self._ai_client = HirasawaAI(
-            base_url=provider['base_url'],
-            api_key=provider['api_key'],
-            model=provider['model'],
-            frequency=ai_config['freq'],
+        # 没有配置时与原来一样：只有ai.freq秒一次的全局调用间隔，不按群和用户限流，freq为0时不限流
+        rate_defaults: dict[str, BucketConfig] = {}
+        if ai_config.get('freq', 0) > 0:
+            rate_defaults['provider'] = BucketConfig(burst=1, rate=1 / ai_config['freq'])
+        self._rate_limiter = RateLimiter.from_config(ai_config.get('rate_limit', {}), defaults=rate_defaults)
+        router_config = ai_config.get('router', {})
+        self._ai_client = AIRouter(
+            {
+                name: HirasawaAsyncAI(
+                    base_url=provider['base_url'],
+                    api_key=provider['api_key'],
+                    model=provider['model'],
+                    max_concurrency=ai_config.get('max_concurrency', 4),
+                )
+                for name, provider in ai_config['providers'].items()
+            },
+            primary=ai_config['provider'],
+            limiter=self._rate_limiter,
+            failure_threshold=router_config.get('failure_threshold', 3),
+            cooldown=router_config.get('cooldown', 60.0),
         )
+        self._ai_stream: bool = ai_config.get('stream', True)
+        # 每个prompt模板发送聊天记录的token预算
+        self._token_budget: dict[str, int] = ai_config.get('token_budget', {})
+        cache_config = ai_config.get('cache', {})
+        self._ai_cache = ResponseCache(
+            maxsize=cache_config.get('maxsize', 128),
+            ttl=cache_config.get('ttl', 120.0),
+        )
+        self._ai_inflight = SingleFlight()
         self.pop_texts = [
             "我是平沢bot，Ciallo～(∠・ω< )⌒☆~",
             "极品人机冒泡儿~",
@@ -93,9 +166,13 @@ class HirasawaBot(NcatBotPlugin):
         return await super().on_load()
         # await self.api.post_private_msg(user_id=self.ADMIN_ID, text='平沢bot已启动！')
     
-    # async def on_close(self):
-    #     yaml.safe_dump(self.config, self.data_file.open('w', encoding='utf-8'))
-    #     return await super().on_close()
+    async def on_close(self, *args, **kwargs):
+        # yaml.safe_dump(self.config, self.data_file.open('w', encoding='utf-8'))
+        for group_id in list(self._pop_jobs):
+            self.cancel_pop(group_id)
+        await self.archive.close()
+        logger.info(f'Reaction stats: {self.reactions.stats()}')
+        return await super().on_close(*args, **kwargs)
 
     async def __pre_command__(self, event: BaseMessageEvent, spec: CommandSpec, *args, **kwargs) -> bool:
         logger.info(f"Executing command '{spec.name}' with args '{args}' and kwargs '{kwargs}'")
@@ -116,6 +193,16 @@ class HirasawaBot(NcatBotPlugin):
     async def __post_command__(self, event: BaseMessageEvent, spec: CommandSpec, *args, **kwargs):
         logger.info(f"Command '{spec.name}' executed with args '{args}' and kwargs '{kwargs}'")
 
+    def __on_sent__(self, event: MessageEventProtocol, msg: MessageArray, message_id: str):
+        if event.message_type != 'group': return
+        self.record(event.group_id, ChatRecord(
+            message_id=str(message_id),
+            message=array2raw(msg),
+            sender_id=str(self.BOT_ID),
+            sender_name=self.name,
+            time=int(time.time()),
+        ))
+
     @on_request
     async def on_request(self, event: RequestEvent):
         if not event.is_friend_request(): return
@@ -171,113 +258,226 @@ class HirasawaBot(NcatBotPlugin):
         await self.congradulate_talkative(event)
             
 
-    def repeat(self, event: GroupMessage):
-        if event.sender.user_id == event.self_id: return
-        history = self.analyse_history(event.group_id)
-        if len(history) < 3: return
-        if history[-1]['message'] != history[-2]['message']: return
-        if history[-2]['message'] != history[-3]['message']: return
+    @reaction_input('raw_text')
+    def _raw_text(self, event: GroupMessage) -> str:
+        return event.raw_message.strip()
+
+    @reaction_input('triggers')
+    def _triggers(self, event: GroupMessage) -> set[str]:
+        return {match.name for match in self.triggers.match(event.raw_message.strip())}
+
+    @reaction_input('streak')
+    def _streak(self, event: GroupMessage) -> Streak:
+        return self.history[event.group_id].streak
+
+    def streak_threshold(self, group_id: str, kind: str) -> int:
+        '''
+        kind为'repeat'或'formation'，默认都是3条
+        '''
+        group_config = self._streak_groups.get(str(group_id), {})
+        if kind in group_config:
+            return group_config[kind]
+        return self._streak_config.get(kind, 3)
+
+    @reaction('streak', cost=Cost.CHEAP, priority=1)
+    def repeat(self, event: GroupMessage, streak: Streak):
+        # 每次复读bot只跟一次
+        if streak.joined: return
+        if streak.length < self.streak_threshold(event.group_id, 'repeat'): return
+        # 不等消息发出去就先标记，避免发送期间又有人复读导致bot跟两次
+        streak.joined = True
         yield event.raw_message
-        yield False
 
 
-    def formation(self, event: GroupMessage):
-        if event.sender.user_id == event.self_id: return
-        history = self.analyse_history(event.group_id)
-        if len(history) < 4: return
-        if not (history[-2]['message'] == history[-3]['message'] == history[-4]['message']): return
-        if history[-1]['message'] != history[-2]['message']:
-            yield Reply(event.message_id), '你这个人怎么随便打乱队形啊！'
-            yield False
+    @reaction('streak', cost=Cost.CHEAP)
+    def formation(self, event: GroupMessage, streak: Streak):
+        if streak.length != 1: return
+        if streak.broken_length < self.streak_threshold(event.group_id, 'formation'): return
+        yield Reply(event.message_id), '你这个人怎么随便打乱队形啊！'
     
-    def heyiwei(self, event: GroupMessage):
-        if event.sender.user_id == event.self_id: return
-        raw_text = event.raw_message.strip()
+    @reaction('raw_text', 'triggers', cost=Cost.MODERATE, priority=1)
+    def heyiwei(self, event: GroupMessage, raw_text: str, triggers: set[str]):
         if len(raw_text) < 3: return
-        for word in batched(raw_text, 3):
-            if pinyin(''.join(word), style=Style.NORMAL) != [['he'], ['yi'], ['wei']]: continue
-            yield "何意味？"
-            yield False
-            return
+        if 'heyiwei' not in triggers: return
+        yield "何意味？"
     
-    def caicaibei(self, event: GroupMessage):
-        if event.sender.user_id == event.self_id: return
-        raw_text = event.raw_message.strip()
+    @reaction('raw_text', 'triggers', cost=Cost.MODERATE)
+    def caicaibei(self, event: GroupMessage, raw_text: str, triggers: set[str]):
         if len(raw_text) != 3: return
         if raw_text[0] != raw_text[1]: return
-        if pinyin(raw_text, Style.FIRST_LETTER, errors='replace') != [['c'], ['c'], ['b']]:
-            return
+        if 'caicaibei' not in triggers: return
         yield f'老爷爷，我给你{raw_text[-2]}{raw_text[-1]}来咯！'
-        yield False
 
-    def group_pop(self, event: GroupMessage):
-        if event.sender.user_id == event.self_id: return
-        group_id = event.group_id
+    def should_pop(self, group_id: str) -> bool:
+        '''
+        O(1)判断是否该冒泡：缓冲区里的消息足够多，且bot三小时内没有在本群发过言
+        '''
+        history = self.history[group_id]
         pop_freq = self.POP_FREQ if group_id != self.TEST_GROUP else 8
-        history = self.analyse_history(group_id)
         if len(history) <= pop_freq:
-            return
-        current_time = time.time()
-        mimic_root = False
-        for msg in history[-1:-1-pop_freq:-1]:
-            if msg['sender_id'] == self.ADMIN_ID:
-                mimic_root = True
-            if msg['sender_id'] == event.self_id and current_time - msg['time'] < 10800:
-                return
-        if not mimic_root:
+            return False
+        last_time = history.last_time(str(self.BOT_ID))
+        return last_time is None or time.time() - last_time >= 10800
+
+    def schedule_pop(self, event: GroupMessage):
+        '''
+        安排冒泡任务：群里安静pop_delay秒后才执行，期间有新消息则取消
+        '''
+        if not self.should_pop(event.group_id): return
+        self.cancel_pop(event.group_id)
+        self._pop_jobs[event.group_id] = asyncio.create_task(self._pop_job(event))
+
+    def cancel_pop(self, group_id: str):
+        job = self._pop_jobs.pop(group_id, None)
+        if job is not None:
+            job.cancel()
+
+    async def _pop_job(self, event: GroupMessage):
+        group_id = event.group_id
+        await asyncio.sleep(self._pop_delay)
+        # 冒泡优先级最低，等本群待发的消息都发完
+        while self.outbound.pending(event) > 0:
+            await asyncio.sleep(self.outbound_interval)
+        # 开始执行后不再被新消息取消，避免白白浪费已经发出的ai请求
+        if self._pop_jobs.get(group_id) is asyncio.current_task():
+            del self._pop_jobs[group_id]
+        if not self.should_pop(group_id): return
+        try:
+            await self.group_pop(event)
+        except Exception as e:
+            logger.error(f'Group pop failed in group {group_id}: {type(e).__name__}: {e}')
+
+    @hirasawa
+    async def group_pop(self, event: GroupMessage):
+        group_id = event.group_id
+        history = self.history[group_id]
+        total = history.total
+        pop_freq = self.POP_FREQ if group_id != self.TEST_GROUP else 8
+        since_admin = history.messages_since(str(self.ADMIN_ID))
+        if since_admin is None or since_admin >= pop_freq:
             pop_text = random.choice(self.pop_texts)
             yield pop_text
-            yield False
             return
         # self.log2admin(f'正在尝试在群{group_id}中鹦鹉学舌')
+        compacted = self.compact('group_pop', history)
         prompt = self.promts['group_pop'].render(
-            history=history,
+            history=compacted,
             ADMIN_ID=self.ADMIN_ID,
             BOT_ID=self.BOT_ID,
         )
-        gen = self.ai_resp(map(lambda x: json.dumps(x, ensure_ascii=False), history), prompt=prompt)
-        texts = [text for text in gen]
+        gen = self.ai_resp(
+            event,
+            [compacted.text],
+            prompt=prompt,
+            stream=False,  # 冒泡只发一条消息
+            key=['group_pop', self.anchor(history)],
+        )
+        texts = [text async for text in gen]
         if len(texts) != 1:
             self.log2admin('\n'.join(texts))
             return
+        # 等ai回复期间群里已经聊到别的了，就不冒泡了
+        if history.total != total: return
         yield texts[0]
-        yield False
 
     @group_filter
     @hirasawa
     async def on_group_message(self, event: GroupMessage) -> AsyncIterator[ItemType]:
-        for item in takewhile(lambda x: x != False, chain(
-            self.repeat(event),
-            self.formation(event),
-            self.heyiwei(event),
-            self.caicaibei(event),
-            self.group_pop(event),
-        )):
+        # bot自己发的消息在__on_sent__中记录，也不触发被动反应
+        if event.sender.user_id == event.self_id: return
+        self.record(event.group_id, ChatRecord.from_message(event))
+        # 群里有新消息，之前安排的冒泡作废
+        self.cancel_pop(event.group_id)
+        await self.load_history(event.group_id)
+        # 第一个触发的被动反应之后，其余的被动反应不再执行
+        fired = False
+        async for item in self.reactions.run(event):
+            fired = True
             yield item
+        if not fired:
+            self.schedule_pop(event)
 
     def log2admin(self, msg: str):
         self.api.post_private_msg_sync(user_id=self.ADMIN_ID, text=msg)
     
-    def ai_resp(self, messages: Iterator[str], prompt: str = ""):
+    async def ai_resp(
+        self,
+        event: GroupMessage,
+        messages: Iterable[str],
+        prompt: str = "",
+        user_id: str | None = None,
+        mode: str = "",
+        stream: bool | None = None,
+        key: Sequence[str] | None = None,
+    ) -> AsyncIterator[str]:
+        '''
+        user_id为None时不按用户限流，例如bot主动冒泡
+        命中缓存的请求不调用ai接口，也不消耗限流令牌
+        key为缓存用的请求标识，默认由prompt与messages计算；
+        基于聊天记录的指令应传入不随bot回显变化的内容，见anchor，群号会自动加入key
+        相同的请求正在进行时，等待它的结果而不是再调用一次ai接口
+        stream为True时边生成边按句子yield，默认使用配置中的ai.stream
+        '''
+        messages = list(messages)
+        if key is None:
+            cache_key = ResponseCache.key(self._ai_client.model, prompt, messages, mode)
+        else:
+            # anchor可能为空（最近只有bot消息与指令），不同群的请求不能共用结果
+            cache_key = ResponseCache.key(self._ai_client.model, '', [str(event.group_id), *key], mode)
+        cached = self._ai_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f'AI response cache hit: {self._ai_cache}')
+            yield cached
+            return
+        pending = self._ai_inflight.join(cache_key)
         try:
-            resp = self._ai_client << {
-                "messages": messages,
-                "prompt": prompt,
-            }
-            yield resp
-        except AssertionError as e:
-            if str(e).startswith("Too frequent requests"):
-                yield "调用ai接口是花钱的啊！平沢原的钱就不是钱吗！请不要频繁调用ai接口！"
-                yield "尝试调用'/sponsor'命令，或许可以缓解…"
-            elif str(e).startswith("Invalid response type"):
-                yield "少女调用ai接口失败T_T"
-                yield f"错误原因：API响应类型错误{str(e)}"
-            elif str(e).startswith("Empty response"):
-                yield "少女调用ai接口失败T_T"
-                yield f"错误原因：后台响应了空字符串"
+            if pending is not None:
+                logger.info(f'AI request joined an in-flight call: {self._ai_inflight}')
+                # shield: 等待的一方被取消时不影响正在进行的请求
+                yield await asyncio.shield(pending)
+                return
+            # join与lead之间不能有await，否则同时到达的相同请求都会错过join，各自调用一次ai接口
+            self._ai_inflight.lead(cache_key)
+            try:
+                # 服务商维度的限流由AIRouter负责
+                await self._rate_limiter.acquire(
+                    group=event.group_id,
+                    user=user_id,
+                )
+                if stream if stream is not None else self._ai_stream:
+                    chunks = []
+                    async for chunk in self._ai_client.stream(messages, prompt):
+                        chunks.append(chunk)
+                        yield chunk
+                    resp = '\n'.join(chunks)
+                    logger.info(f'AI time to first token: {self._ai_client.ttft[-1]:.2f}s (mean {self._ai_client.mean_ttft:.2f}s)')
+                    logger.info(f'AI providers: {self._ai_client.stats()}')
+                else:
+                    resp = await (self._ai_client << {
+                        "messages": messages,
+                        "prompt": prompt,
+                    })
+                    yield resp
+            except BaseException as e:
+                self._ai_inflight.reject(cache_key, e)
+                raise
+            self._ai_inflight.resolve(cache_key, resp)
+            self._ai_cache.put(cache_key, resp)
+        except RateLimitExceeded as e:
+            yield "调用ai接口是花钱的啊！平沢原的钱就不是钱吗！请不要频繁调用ai接口！"
+            if e.scope == 'user':
+                yield f"你调用得太频繁了，请{math.ceil(e.retry_after)}秒后再试"
+            elif e.scope == 'group':
+                yield f"本群调用得太频繁了，请{math.ceil(e.retry_after)}秒后再试"
             else:
-                yield "少女调用ai接口失败T_T"
-                yield f"其他失败原因：其他断言错误{str(e)}"
+                yield f"请{math.ceil(e.retry_after)}秒后再试"
+            yield "尝试调用'/sponsor'命令，或许可以缓解…"
+        except AIResponseError as e:
+            yield "少女调用ai接口失败T_T"
+            yield f"错误原因：{str(e)}"
+        except ProviderUnavailable as e:
+            yield "少女调用ai接口失败T_T"
+            yield "错误原因：所有ai服务商都暂时不可用，请稍后再试"
         except openai.APIStatusError as e:
             yield "少女调用ai接口失败T_T"
             if e.status_code == 429:
@@ -304,16 +504,39 @@ class HirasawaBot(NcatBotPlugin):
             yield "少女调用ai接口失败T_T"
             yield f"其他失败原因：{str(e)}"
     
-    def analyse_history(self, group_id: str) -> list[dict]:
-        messages_history = self.api.get_group_msg_history_sync(group_id=group_id, message_seq=0, number=self.MAX_HISTORY)
-        history = []
-        for message in messages_history:
-            history.append({
-                "message": message.raw_message,
-                "sender_id": message.sender.user_id,
-                "sender_name": message.sender.card if message.sender.card != '' else message.sender.nickname,
-                "time": message.time,
-            })
+    def record(self, group_id: str, record: ChatRecord):
+        self.history[group_id].append(record)
+        self.archive.append(group_id, record)
+
+    def anchor(self, history: Iterable[ChatRecord]) -> str:
+        '''
+        聊天记录窗口的缓存标识，见conversation_anchor
+        '''
+        return conversation_anchor(history, bot_id=str(self.BOT_ID))
+
+    def compact(self, template: str, history: Iterable[ChatRecord]) -> CompactHistory:
+        '''
+        按模板对应的token预算压缩聊天记录，默认预算为2000
+        '''
+        return compact_history(
+            list(history),
+            budget=self._token_budget.get(template, 2000),
+            bot_id=str(self.BOT_ID),
+        )
+
+    async def load_history(self, group_id: str) -> GroupHistory:
+        '''
+        返回本群的聊天记录缓冲区
+        每个群只在第一次使用时调用一次NapCat的历史记录接口
+        '''
+        history = self.history[group_id]
+        if history.bootstrapped:
+            return history
+        messages_history = await self.api.get_group_msg_history(group_id, 0, self.MAX_HISTORY)
+        records = [ChatRecord.from_message(message) for message in messages_history]
+        history.bootstrap(records)
+        for record in records:
+            self.archive.append(group_id, record)
         return history
     
     @group_filter
@@ -370,18 +593,24 @@ class HirasawaBot(NcatBotPlugin):
             yield f"调用ai接口是花钱的啊！平沢原的钱就不是钱吗！请把参数限制在{self.MAX_HISTORY // 2}以内"
             # yield self.SPONSOR
             return
-        history = self.analyse_history(event.group_id)[:-1]
-        history = history if len(history) <= self.MAX_HISTORY // 2 else history[-self.MAX_HISTORY // 2:]
+        history = (await self.load_history(event.group_id)).tail(self.MAX_HISTORY // 2, exclude=event.message_id)
         if len(history) < 0:
             yield "bot暂未收到本群任何消息"
         history = history if num > len(history) else history[-num:]
+        compacted = self.compact('analyse_jokes', history)
         prompt = self.promts['analyse_jokes'].render(
-            history=history,
+            history=compacted,
             ADMIN_ID=self.ADMIN_ID,
             BOT_ID=self.BOT_ID,
         )
         yield "少女解析笑点中…"
-        for msg in self.ai_resp(map(lambda x: json.dumps(x, ensure_ascii=False), history), prompt=prompt):
+        async for msg in self.ai_resp(
+            event,
+            [compacted.text],
+            prompt=prompt,
+            user_id=event.sender.user_id,
+            key=['analyse_jokes', str(num), self.anchor(history)],
+        ):
             yield msg
         
     @group_filter
@@ -396,8 +625,8 @@ class HirasawaBot(NcatBotPlugin):
         输入小于等于三位的数字模仿上面的第n个人，即/mimic 2模仿上上一个人
         也可以直接@，例如：/mimic @平沢bot
         '''
-        history = self.analyse_history(event.group_id)[:-1]
-        history = history if len(history) <= self.MAX_HISTORY // 2 else history[-self.MAX_HISTORY // 2:]
+        group_history = await self.load_history(event.group_id)
+        history = group_history.tail(self.MAX_HISTORY // 2, exclude=event.message_id)
         sender_id = event.sender.user_id
         if sender_id == 'invalid':
             yield f"无效的QQ号！"
@@ -406,23 +635,25 @@ class HirasawaBot(NcatBotPlugin):
         if len(history) < 20:
             yield f"bot接收到的本群聊天记录仅有{len(history)}条，请稍后再试"
             return
-        has_user_talked = False
-        for msg in history:
-            if msg['sender_id'] == mimic_user_id:
-                has_user_talked = True
-                break
-        if not has_user_talked:
+        # 与prompt使用同一个窗口判断，触发指令的消息已经在tail中按message_id排除
+        compacted = self.compact('mimic', history)
+        if not compacted.has_talked(mimic_user_id):
             yield f"该用户{mimic_user_id}在最近{len(history)}条聊天记录中未发言，无法模仿"
             return
         prompt = self.promts['mimic'].render(
             mimic_user_id=mimic_user_id,
-            history=history,
+            history=compacted,
             ADMIN_ID=self.ADMIN_ID,
             BOT_ID=self.BOT_ID,
         )
         yield "少女模仿杂鱼中…"
-        # yield from self.ai_resp_old(map(lambda x: json.dumps(x, ensure_ascii=False), history), prompt=prompt)
-        for msg in self.ai_resp(map(lambda x: json.dumps(x, ensure_ascii=False), history), prompt=prompt):
+        async for msg in self.ai_resp(
+            event,
+            [compacted.text],
+            prompt=prompt,
+            user_id=event.sender.user_id,
+            key=['mimic', str(mimic_user_id), self.anchor(history)],
+        ):
             yield msg
 
     @group_filter
@@ -439,8 +670,8 @@ class HirasawaBot(NcatBotPlugin):
         输入小于等于三位的数字评价上面的第n个人，即/critic 2评价上上一个人
         也可以直接@，例如：/critic @平沢bot
         '''
-        history = self.analyse_history(event.group_id)[:-1]
-        history = history if len(history) <= self.MAX_HISTORY // 2 else history[-self.MAX_HISTORY // 2:]
+        group_history = await self.load_history(event.group_id)
+        history = group_history.tail(self.MAX_HISTORY // 2, exclude=event.message_id)
         sender_id = event.sender.user_id
         critic_user_id = get_user_info(critic_user_id, history, sender_id)
         # 如果评价的是bot主人
@@ -453,12 +684,9 @@ class HirasawaBot(NcatBotPlugin):
         if len(history) < 20:
             yield f"bot接收到的本群聊天记录仅有{len(history)}条，请稍后再试"
             return
-        has_user_talked = False
-        for msg in history:
-            if msg['sender_id'] == critic_user_id:
-                has_user_talked = True
-                break
-        if not has_user_talked:
+        # 与prompt使用同一个窗口判断，触发指令的消息已经在tail中按message_id排除
+        compacted = self.compact('critic', history)
+        if not compacted.has_talked(critic_user_id):
             yield f"该用户{critic_user_id}在最近{len(history)}条聊天记录中未发言，无法评价"
             return
         choice = random.randint(1, 6)  # 随机生成1到6之间的整数
@@ -474,15 +702,37 @@ class HirasawaBot(NcatBotPlugin):
             mode = '尽可能崇高的褒奖与吹捧'
         prompt = self.promts['critic'].render(
             critic_user_id=critic_user_id,
-            history=history,
+            history=compacted,
             mode=mode,
             ADMIN_ID=self.ADMIN_ID,
             BOT_ID=self.BOT_ID,
         )
         yield "少女评价杂鱼中…"
-        for msg in self.ai_resp(map(lambda x: json.dumps(x, ensure_ascii=False), history), prompt=prompt):
+        async for msg in self.ai_resp(
+            event,
+            [compacted.text],
+            prompt=prompt,
+            user_id=event.sender.user_id,
+            mode=mode,
+            key=['critic', str(critic_user_id), self.anchor(history)],
+        ):
             yield msg
         
+    async def isaac_card(self, item_type: str, info: dict, no_desc: bool, lang: str | None) -> list[str | Path] | Path:
+        '''
+        配置了isaac_card时返回渲染好的卡片图片，否则（或无法渲染时）返回原来的图文列表
+        '''
+        desc = eid_description(item_type, self.ISAAC_ROOT, info, no_desc, icons=self.isaac_icons)
+        if self.isaac_cards is None:
+            return desc
+        key = f"{item_type}_{info['id']}_{lang or self.isaac.default_lang}_{'n' if no_desc else 'd'}"
+        try:
+            card = await asyncio.to_thread(self.isaac_cards.render, desc, key)
+        except Exception as e:
+            logger.error(f'Failed to render EID card {key}: {type(e).__name__}: {e}')
+            return desc
+        return desc if card is None else card
+
     @group_filter
     @command_registry.command('isaac', aliases=['以撒的结合', '以撒'])
     # @hirasawa_option.no_desc('不输出道具/饰品的描述')
@@ -491,49 +741,48 @@ class HirasawaBot(NcatBotPlugin):
         '''
         输入《以撒的结合：忏悔》中的道具编号或饰品编号，或者直接输入名称，输出对应的图片以及EID描述。
         加入-n参数将不输出道具/饰品的描述
-        （输入名称检索暂时仅支持中文，并且如果提供的词汇太少，则会使用最早搜索到的道具/饰品）
+        名称支持中文、全拼与拼音首字母，匹配不唯一时会列出其它候选
+        在前面加上"语言:"可以指定EID的语言，不指定时使用本群的默认语言
         例如：
           - /isaac C118
           - /isaac 妈妈的菜刀
-          - /isaac -n 妈妈的菜刀
+          - /isaac caidao
+          - /isaac -n mmdcd
+          - /isaac en_us:C118
         '''
         no_desc = options.get('no_desc', False)
-        if arg[0].upper() == 'C':
+        lang = self._isaac_group_lang.get(str(event.group_id))
+        prefix, sep, rest = arg.partition(':')
+        if sep and prefix in self.isaac.languages:
+            lang, arg = prefix, rest.strip()
+        if arg == '':
+            yield "请输入道具/饰品的编号或名称！"
+            return
+        if arg[0].upper() == 'C' and arg[1:].isdigit():
             item_id = arg[1:]
-            if not item_id.isdigit():
-                yield "无效的编号！"
-                return
-            info = self.isaac_collectibles.get(int(item_id), None)
+            info = self.isaac.get('collectibles', int(item_id), lang)
             if info is None:
                 yield "未找到该道具！"
                 return
-            yield eid_description('collectibles', self.ISAAC_ROOT, info, no_desc)
-        elif arg[0].upper() == 'T':
+            yield await self.isaac_card('collectibles', info, no_desc, lang)
+        elif arg[0].upper() == 'T' and arg[1:].isdigit():
             item_id = arg[1:]
-            if not item_id.isdigit():
-                yield "无效的编号！"
-                return
-            info = self.isaac_trinkets.get(int(item_id), None)
+            info = self.isaac.get('trinkets', int(item_id), lang)
             if info is None:
                 yield "未找到该饰品！"
                 return
-            yield eid_description('trinkets', self.ISAAC_ROOT, info, no_desc)
-        else:  # 中文检索
-            found = False
-            for info in self.isaac_collectibles.values():
-                name = info['name']
-                if arg not in name: continue
-                found = True
-                yield eid_description('collectibles', self.ISAAC_ROOT, info, no_desc)
+            yield await self.isaac_card('trinkets', info, no_desc, lang)
+        else:  # 名称检索
+            pack, hits = self.isaac.search(arg, lang, top_k=self.ISAAC_CANDIDATES)
+            if pack is None:
+                yield "未找到该道具/饰品！"
                 return
-            for info in self.isaac_trinkets.values():
-                name = info['name']
-                if arg not in name: continue
-                found = True
-                yield eid_description('trinkets', self.ISAAC_ROOT, info, no_desc)
+            best = hits[0]
+            info = pack.items[best.item_type][best.item_id]
+            yield await self.isaac_card(best.item_type, info, no_desc, pack.lang)
+            if best.rank == MatchRank.EXACT or len(hits) == 1:
                 return
-            if not found:
-                yield "未找到该道具/饰品！"
+            yield '你要找的可能是：\n' + '\n'.join(f'{hit.code} {hit.name}' for hit in hits[1:])
     
     @group_filter
     @command_registry.command('kick')
@@ -552,6 +801,7 @@ class HirasawaBot(NcatBotPlugin):
         role = sender.role
         if user_id == self.ADMIN_ID or role == 'owner' or role == 'admin':
             yield "正在退出群聊..."
+            yield FLUSH
             self.api.set_group_leave_sync(group_id)
             return
         yield "只有群管理员与bot主人可以使用该命令！"
@@ -588,6 +838,7 @@ class HirasawaBot(NcatBotPlugin):
         只有bot管理员可以使用
         '''
         yield "正在关闭bot..."
+        yield FLUSH
         self.api.bot_exit_sync()
         return
 
@@ -1,9 +1,172 @@
+import asyncio
+import hashlib
+import json
 import time
-from openai import AsyncOpenAI, OpenAI
+from collections import OrderedDict, deque
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DEFAULT_CONNECTION_LIMITS, APIConnectionError, APIStatusError
 from openai.types.chat import ChatCompletion
-from typing import Any, Iterator, Final
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Iterable, Final, Sequence
 from abc import ABC, abstractmethod
 
+from .ratelimit_utils import RateLimiter, RateLimitExceeded
+
+
+class AIResponseError(Exception):
+    '''
+    ai接口返回了空字符串或者非字符串内容
+    '''
+
+
+def _check_content(content: Any) -> str:
+    if not isinstance(content, str):
+        raise AIResponseError(f"Invalid response type: {type(content)}")
+    if content == "":
+        raise AIResponseError("Empty response")
+    return content
+
+
+def _build_messages(messages: Iterable[str], prompt: str = "") -> list:
+    req_messages: list = []
+    if prompt != "":
+        req_messages.append({
+            "role": "system",
+            "content": [
+                {"type": "text", "text": prompt}
+            ],
+        })
+    req_messages.append({
+        "role": "user",
+        "content": [
+            {"type": "text", "text": '\n'.join(messages)}
+        ],
+    })
+    return req_messages
+
+
+class SentenceChunker:
+    '''
+    把流式返回的文本按句子切开，每段至少min_length个字符（最后一段除外）
+    句末连续的标点（例如'！！'、'……'）会留在同一段里
+    '''
+    SENTENCE_ENDS: Final[str] = '。！？!?；;…~～\n'
+
+    def __init__(self, min_length: int = 16) -> None:
+        self._buffer = ''
+        self._min_length = min_length
+
+    def feed(self, text: str) -> list[str]:
+        self._buffer += text
+        chunks: list[str] = []
+        start = 0
+        i = 0
+        while i < len(self._buffer):
+            if self._buffer[i] not in self.SENTENCE_ENDS or i + 1 - start < self._min_length:
+                i += 1
+                continue
+            while i + 1 < len(self._buffer) and self._buffer[i + 1] in self.SENTENCE_ENDS:
+                i += 1
+            if i + 1 == len(self._buffer):
+                break  # 后面可能还有标点没收到，等下一次
+            chunk = self._buffer[start:i + 1].strip()
+            if chunk != '':
+                chunks.append(chunk)
+            start = i + 1
+            i += 1
+        self._buffer = self._buffer[start:]
+        return chunks
+
+    def flush(self) -> str:
+        rest, self._buffer = self._buffer.strip(), ''
+        return rest
+
+
+class ResponseCache:
+    '''
+    ai回复的LRU缓存，最多保存maxsize条，每条ttl秒后过期
+    同一个群里短时间内多人用相同参数调用同一个指令时，直接返回上一次的回复
+    '''
+    def __init__(self, maxsize: int = 128, ttl: float = 120.0) -> None:
+        self._data: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, prompt: str, messages: Sequence[str], mode: str = "") -> str:
+        payload = json.dumps([model, prompt, list(messages), mode], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expire, value = item
+        if expire < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: str) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __repr__(self) -> str:
+        return f'ResponseCache(size={len(self)}/{self.maxsize}, hits={self.hits}, misses={self.misses})'
+
+
+class SingleFlight:
+    '''
+    合并正在进行中的相同请求：同一个key同时只有一个请求真正调用ai接口
+    其余请求挂在它的future上，拿到同一个回复，saved记录省下的调用次数
+    '''
+    def __init__(self) -> None:
+        self._pending: dict[str, asyncio.Future[str]] = {}
+        self.saved = 0
+
+    def join(self, key: str) -> asyncio.Future[str] | None:
+        '''
+        有相同的请求正在进行时返回它的future，否则返回None
+        '''
+        future = self._pending.get(key)
+        if future is not None:
+            self.saved += 1
+        return future
+
+    def lead(self, key: str) -> asyncio.Future[str]:
+        future = self._pending[key] = asyncio.get_running_loop().create_future()
+        return future
+
+    def resolve(self, key: str, value: str) -> None:
+        future = self._pending.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(value)
+
+    def reject(self, key: str, exc: BaseException) -> None:
+        future = self._pending.pop(key, None)
+        if future is None or future.done():
+            return
+        if not isinstance(exc, Exception):
+            # 发起请求的一方被取消或关闭，不能把GeneratorExit之类的异常传给其他人
+            exc = AIResponseError('合并的请求被中断')
+        future.set_exception(exc)
+        future.exception()  # 没有人等待时不要报"exception was never retrieved"
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def __repr__(self) -> str:
+        return f'SingleFlight(pending={len(self)}, saved={self.saved})'
+
 
 class Requirable[T](ABC):
     @abstractmethod
@@ -41,68 +204,287 @@ resp = my_web['/index.html'] << {
 '''
     
 class HirasawaAsyncAI(AsyncOpenAI, AsyncRequirable):
-    def __init__(self, *, model: str, frequency: float = 1.0,  **kwargs) -> None:
+    '''
+    max_concurrency: 同时进行中的请求数上限，超出的请求会排队等待
+    max_connections: http连接池大小，请求之间复用连接
+    限流由调用方的RateLimiter负责
+    '''
+    def __init__(
+        self, *,
+        model: str,
+        max_concurrency: int = 4,
+        max_connections: int = 8,
+        **kwargs
+    ) -> None:
+        if 'http_client' not in kwargs:
+            # 用openai自己的httpx版本中的Limits，不直接依赖httpx
+            kwargs['http_client'] = DefaultAsyncHttpxClient(limits=type(DEFAULT_CONNECTION_LIMITS)(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ))
         super().__init__(**kwargs)
-        self._frequency: Final[float] = frequency
-        self._last_request_time: float = 0.0
         self._model: str = model
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.ttft: deque[float] = deque(maxlen=100)  # 最近的流式请求首个token的耗时（秒）
     
-    async def __call__(self, messages: Iterator[str], prompt: str = "", index: int = 0, **kwargs):
-        assert time.time() - self._last_request_time > self._frequency, "Too frequent requests"
-        req_messages: list = []
-        if prompt != "":
-            req_messages.append({
-                "role": "system",
-                "content": [
-                    {"type": "text", "text": prompt}
-                ],
-            })
-        for msg in messages:
-            req_messages.append({
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": msg}
-                ],
-            })
-        resp = await self.chat.completions.create(
-            model=self._model,
-            messages=req_messages,
-            **kwargs
-        )
-        self._last_request_time = time.time()
-        return resp.choices[index].message.content
+    @property
+    def model(self) -> str:
+        return self._model
+    
+    @property
+    def mean_ttft(self) -> float | None:
+        if len(self.ttft) == 0:
+            return None
+        return sum(self.ttft) / len(self.ttft)
+    
+    async def __call__(self, messages: Iterable[str], prompt: str = "", index: int = 0, **kwargs) -> str:
+        async with self._semaphore:
+            resp: ChatCompletion = await self.chat.completions.create(
+                model=self._model,
+                messages=_build_messages(messages, prompt),
+                **kwargs
+            )
+        return _check_content(resp.choices[index].message.content)
+    
+    async def stream(
+        self,
+        messages: Iterable[str],
+        prompt: str = "",
+        index: int = 0,
+        min_length: int = 16,
+        on_first_token: Callable[[float], None] | None = None,
+        **kwargs
+    ) -> AsyncGenerator[str, None]:
+        '''
+        流式请求，按句子yield回复内容，见SentenceChunker
+        收到第一个token时调用on_first_token(耗时秒数)，此时第一句话可能还没有凑齐
+        '''
+        chunker = SentenceChunker(min_length)
+        received = False
+        async with self._semaphore:
+            start = time.monotonic()
+            resp = await self.chat.completions.create(
+                model=self._model,
+                messages=_build_messages(messages, prompt),
+                stream=True,
+                **kwargs
+            )
+            async for event in resp:
+                if len(event.choices) <= index:
+                    continue
+                delta = event.choices[index].delta.content
+                if not delta:
+                    continue
+                if not received:
+                    received = True
+                    ttft = time.monotonic() - start
+                    self.ttft.append(ttft)
+                    if on_first_token is not None:
+                        on_first_token(ttft)
+                for chunk in chunker.feed(delta):
+                    yield chunk
+        rest = chunker.flush()
+        if rest != '':
+            yield rest
+        if not received:
+            raise AIResponseError("Empty response")
         
 
-class HirasawaAI(OpenAI, Requirable):
-    def __init__(self, *, model: str, frequency: float = 1.0, **kwargs) -> None:
-        super().__init__(**kwargs)
-        self._frequency: Final[float] = frequency
-        self._last_request_time: float = 0.0
-        self._model: str = model
-    
-    def __call__(self, messages: Iterator[str], prompt: str = "", index: int = 0, **kwargs):
-        assert time.time() - self._last_request_time > self._frequency, "Too frequent requests"
-        req_messages: list = []
-        if prompt != "":
-            req_messages.append({
-                "role": "system",
-                "content": [
-                    {"type": "text", "text": prompt}
-                ],
-            })
-        req_messages.append({
-            "role": "user",
-            "content": [
-                {"type": "text", "text": '\n'.join(messages)}
-            ],
-        })
-        resp: ChatCompletion = self.chat.completions.create(
-            model=self._model,
-            messages=req_messages,
-            **kwargs
+class ProviderUnavailable(Exception):
+    '''
+    所有服务商都处于熔断状态
+    '''
+
+
+def _retryable(e: Exception) -> bool:
+    '''
+    429、5xx、超时与连接错误可以换一个服务商重试
+    '''
+    if isinstance(e, APIConnectionError):  # 包括APITimeoutError
+        return True
+    if isinstance(e, APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    return False
+
+
+class _Provider:
+    __slots__ = ('name', 'client', 'latency', 'results', 'failures', 'open_until', 'probing')
+
+    def __init__(self, name: str, client: HirasawaAsyncAI, window: int) -> None:
+        self.name = name
+        self.client = client
+        self.latency: float | None = None  # 延迟的指数滑动平均（秒）
+        self.results: deque[bool] = deque(maxlen=window)  # 最近的请求是否成功
+        self.failures = 0  # 连续失败次数
+        self.open_until = 0.0  # 熔断到什么时候，0表示没有熔断
+        self.probing = False  # 熔断到期后是否已经有一个试探请求在进行
+
+    @property
+    def error_rate(self) -> float:
+        if len(self.results) == 0:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+    def available(self, now: float) -> bool:
+        if self.open_until == 0.0:
+            return True
+        # 半开：熔断到期后只放一个试探请求，结果出来之前其余请求继续跳过
+        return self.open_until <= now and not self.probing
+
+    def score(self, prior: float) -> float:
+        # 没有延迟数据时按其他服务商的平均延迟估计，不会仅仅因为没用过就排到主服务商前面
+        latency = self.latency if self.latency is not None else prior
+        return latency * (1 + 4 * self.error_rate)
+
+
+class AIRouter(AsyncRequirable):
+    '''
+    持有所有配置的服务商，每次请求发给当前最快且健康的服务商
+      - 按延迟的指数滑动平均和最近window次请求的错误率给服务商打分，分数低的优先
+      - 429、5xx、超时时换下一个服务商重试
+      - 连续失败failure_threshold次后熔断cooldown秒，期间直接跳过，到期后只放一个请求试探，
+        试探成功恢复，失败则再熔断cooldown秒
+      - limiter不为空时，按服务商维度限流，被限流的服务商同样跳过
+    '''
+    def __init__(
+        self,
+        clients: dict[str, HirasawaAsyncAI],
+        primary: str | None = None,
+        limiter: RateLimiter | None = None,
+        failure_threshold: int = 3,
+        cooldown: float = 60.0,
+        alpha: float = 0.3,
+        window: int = 20,
+    ) -> None:
+        if len(clients) == 0:
+            raise ValueError('AIRouter requires at least one client')
+        self._providers = [_Provider(name, client, window) for name, client in clients.items()]
+        # 主服务商排在最前面，分数相同时优先使用
+        self._providers.sort(key=lambda p: p.name != primary)
+        self._limiter = limiter
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._alpha = alpha
+        self.ttft: deque[float] = deque(maxlen=100)
+
+    @property
+    def model(self) -> str:
+        return '|'.join(p.client.model for p in self._providers)
+
+    @property
+    def mean_ttft(self) -> float | None:
+        if len(self.ttft) == 0:
+            return None
+        return sum(self.ttft) / len(self.ttft)
+
+    def _candidates(self) -> list[_Provider]:
+        now = time.monotonic()
+        healthy = [p for p in self._providers if p.available(now)]
+        if len(healthy) == 0:
+            raise ProviderUnavailable('All AI providers are unavailable')
+        sampled = [p.latency for p in self._providers if p.latency is not None]
+        prior = sum(sampled) / len(sampled) if len(sampled) > 0 else 0.0
+        return sorted(healthy, key=lambda p: p.score(prior))
+
+    def _acquire(self, provider: _Provider) -> RateLimitExceeded | None:
+        if self._limiter is None:
+            return None
+        return self._limiter.check(provider=provider.name)
+
+    def _success(self, provider: _Provider, latency: float) -> None:
+        provider.results.append(True)
+        provider.failures = 0
+        provider.open_until = 0.0
+        provider.probing = False
+        if provider.latency is None:
+            provider.latency = latency
+        else:
+            provider.latency = self._alpha * latency + (1 - self._alpha) * provider.latency
+
+    def _failure(self, provider: _Provider) -> None:
+        provider.results.append(False)
+        provider.failures += 1
+        # 试探请求失败时直接重新熔断
+        if provider.failures >= self._failure_threshold or provider.probing:
+            provider.open_until = time.monotonic() + self._cooldown
+        provider.probing = False
+
+    async def _route[T](self, attempt: Callable[[_Provider], Awaitable[T]]) -> T:
+        waited = 0.0
+        while True:
+            limited: RateLimitExceeded | None = None
+            error: Exception | None = None
+            for provider in self._candidates():
+                rate_limited = self._acquire(provider)
+                if rate_limited is not None:
+                    if limited is None or rate_limited.retry_after < limited.retry_after:
+                        limited = rate_limited
+                    continue
+                if provider.open_until != 0.0:
+                    provider.probing = True
+                try:
+                    return await attempt(provider)
+                except Exception as e:
+                    if not _retryable(e):
+                        raise
+                    self._failure(provider)
+                    error = e
+                finally:
+                    # 试探请求因为其他原因（例如参数错误、被取消）没有结果时，下一个请求继续试探
+                    provider.probing = False
+            if error is not None:
+                raise error
+            assert limited is not None
+            if self._limiter is None or not self._limiter.wait or waited + limited.retry_after > self._limiter.max_wait:
+                raise limited
+            await asyncio.sleep(limited.retry_after)
+            waited += limited.retry_after
+
+    async def __call__(self, messages: Iterable[str], prompt: str = "", index: int = 0, **kwargs) -> str:
+        messages = list(messages)
+        async def attempt(provider: _Provider) -> str:
+            start = time.monotonic()
+            resp = await provider.client(messages, prompt, index, **kwargs)
+            self._success(provider, time.monotonic() - start)
+            return resp
+        return await self._route(attempt)
+
+    async def stream(self, messages: Iterable[str], prompt: str = "", **kwargs) -> AsyncIterator[str]:
+        '''
+        只有在收到第一段回复之前出错才会换服务商重试，之后的错误直接抛出，同样计入该服务商的失败次数
+        ttft与延迟都按第一个token计算，而不是凑齐第一句话的时间
+        '''
+        messages = list(messages)
+        async def attempt(provider: _Provider) -> tuple[_Provider, AsyncGenerator[str, None], str | None]:
+            start = time.monotonic()
+            first_token: list[float] = []
+            gen = provider.client.stream(messages, prompt, on_first_token=first_token.append, **kwargs)
+            try:
+                first = await anext(gen)
+            except StopAsyncIteration:
+                first = None
+            except Exception:
+                await gen.aclose()
+                raise
+            latency = first_token[0] if len(first_token) > 0 else time.monotonic() - start
+            self._success(provider, latency)
+            self.ttft.append(latency)
+            return provider, gen, first
+        provider, gen, first = await self._route(attempt)
+        if first is None:
+            return
+        yield first
+        try:
+            async for chunk in gen:
+                yield chunk
+        except Exception:
+            self._failure(provider)
+            raise
+
+    def stats(self) -> str:
+        now = time.monotonic()
+        return '; '.join(
+            f"{p.name}: latency={'-' if p.latency is None else f'{p.latency:.2f}s'}, "
+            f"error_rate={p.error_rate:.0%}{', open' if p.open_until > now else ''}"
+            for p in self._providers
         )
-        self._last_request_time = time.time()
-        content = resp.choices[index].message.content
-        assert content != "", "Empty response"
-        assert isinstance(content, str), f"Invalid response type: {type(content)}"
-        return content
\ No newline at end of file
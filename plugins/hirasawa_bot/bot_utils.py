@@ -1,11 +1,14 @@
 from __future__ import annotations
 
+import asyncio
+from collections import deque
 from functools import wraps
 from pathlib import Path
 from warnings import deprecated  # type: ignore
 
 from typing import (
     Iterator,
+    Sequence,
     AsyncIterator,
     Any,
     Callable,
@@ -16,7 +19,7 @@ from typing import (
     runtime_checkable,
 )
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from jinja2 import Environment, FileSystemLoader, Template
 
 
@@ -49,9 +52,19 @@ from ncatbot.utils import get_log, status, assets
 from ncatbot.plugin_system.builtin_plugin.unified_registry.command_system.utils.specs import CommandSpec
 
 from .falsifysignature import flatten_args, flatten_kwargs, append_keyargs
+from .history_utils import ChatRecord
 
 
-type ItemType = str | int | float | bool | Path | MessageSegment
+class Flush:
+    '''
+    在hirasawa方法中yield FLUSH，会等待之前yield的消息全部发送完毕再继续执行
+    例如退群、关机前需要确保提示消息已经发出去
+    '''
+    __repr__ = lambda self: 'FLUSH'
+
+
+FLUSH = Flush()
+type ItemType = str | int | float | bool | Path | MessageSegment | Flush
 logger = get_log()
 permissions: dict[str, int] = {}
 
@@ -113,7 +126,7 @@ def get_role_level(user_id: str) -> int:
     return 1024
 
 
-def get_user_info(arg: str, history: list[dict[str, Any]], sender_id: str) -> str:
+def get_user_info(arg: str, history: Sequence[ChatRecord], sender_id: str) -> str:
     if arg.startswith('At(qq="') and arg.endswith('")'):
         return arg[7:-2]
     if arg == '':
@@ -127,7 +140,7 @@ def get_user_info(arg: str, history: list[dict[str, Any]], sender_id: str) -> st
         return 'invalid'
     if num == 0:
         return sender_id
-    return history[-num]['sender_id']
+    return history[-num].sender_id
 
 
 def load_prompts(jinja2_root: Path) -> dict[str, Template]:
@@ -163,9 +176,158 @@ def parse2array(
         return MessageArray(Text(text=text[0:256 if len(text) > 256 else len(text)]))
 
 
+def array2raw(msg: MessageArray) -> str:
+    '''
+    把bot发出的消息还原成近似raw_message的字符串，用于写入聊天记录
+    非文本消息段只保留类型，例如'[CQ:image]'
+    '''
+    parts = []
+    for seg in msg.to_list():
+        if seg['type'] == 'text':
+            parts.append(seg['data']['text'])
+        else:
+            parts.append(f"[CQ:{seg['type']}]")
+    return ''.join(parts)
+
+
+def plain_text(msg: MessageArray) -> str | None:
+    '''
+    如果消息只由文本组成，返回其文本，否则返回None
+    '''
+    segs = msg.to_list()
+    if len(segs) == 0 or any(seg['type'] != 'text' for seg in segs):
+        return None
+    return ''.join(seg['data']['text'] for seg in segs)
+
+
+@dataclass
+class _SendTarget:
+    items: deque[tuple[MessageEventProtocol, MessageArray, asyncio.Future]] = field(default_factory=deque)
+    wakeup: asyncio.Event = field(default_factory=asyncio.Event)
+    task: asyncio.Task | None = None
+    last_send: float = 0.0
+
+
+class OutboundQueue:
+    '''
+    异步发送队列，每个发送目标（群或私聊）一个队列，由各自的协程依次发送：
+      - 同一目标的消息按yield的顺序发送，不同目标之间互不阻塞
+      - window秒内连续yield的纯文本会合并成一条消息（合并后不超过max_length个字符）
+      - 同一目标两次发送之间至少间隔interval秒
+    '''
+    def __init__(
+        self,
+        plugin: NcatBotPlugin,
+        interval: float = 0.5,
+        window: float = 0.2,
+        max_length: int = 512,
+    ) -> None:
+        self._plugin = plugin
+        self._interval = interval
+        self._window = window
+        self._max_length = max_length
+        self._targets: dict[tuple[str, str], _SendTarget] = {}
+
+    @staticmethod
+    def _key(event: MessageEventProtocol) -> tuple[str, str]:
+        if event.message_type == 'group':
+            return ('group', event.group_id)
+        if event.message_type == 'private':
+            return ('private', event.user_id)
+        raise TypeError(f"Unsupported event type: {event.message_type}")
+
+    def pending(self, event: MessageEventProtocol) -> int:
+        '''
+        返回发往该事件所在群（或私聊）还未发出的消息条数
+        '''
+        target = self._targets.get(self._key(event))
+        return 0 if target is None else len(target.items)
+
+    def put(self, event: MessageEventProtocol, msg: MessageArray) -> asyncio.Future:
+        '''
+        将消息放入队列，返回的future在消息发出后得到message_id，发送失败则为空字符串
+        '''
+        key = self._key(event)
+        target = self._targets.get(key)
+        if target is None:
+            target = self._targets[key] = _SendTarget()
+        future = asyncio.get_running_loop().create_future()
+        target.items.append((event, msg, future))
+        target.wakeup.set()
+        if target.task is None or target.task.done():
+            target.task = asyncio.create_task(self._run(key, target))
+        return future
+
+    async def _next_batch(
+        self, target: _SendTarget
+    ) -> tuple[MessageEventProtocol, MessageArray, list[asyncio.Future]]:
+        event, msg, future = target.items.popleft()
+        futures = [future]
+        text = plain_text(msg)
+        if text is None:
+            return event, msg, futures
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._window
+        while True:
+            if len(target.items) > 0:
+                next_text = plain_text(target.items[0][1])
+                if next_text is None or len(text) + len(next_text) + 1 > self._max_length:
+                    break
+                _, _, next_future = target.items.popleft()
+                text = f'{text}\n{next_text}'
+                futures.append(next_future)
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            target.wakeup.clear()
+            try:
+                await asyncio.wait_for(target.wakeup.wait(), timeout)
+            except TimeoutError:
+                break
+        if len(futures) == 1:
+            return event, msg, futures
+        return event, MessageArray(Text(text=text)), futures
+
+    async def _run(self, key: tuple[str, str], target: _SendTarget) -> None:
+        message_type, send_id = key
+        api = self._plugin.api
+        send_msg = api.send_group_msg if message_type == 'group' else api.send_private_msg
+        loop = asyncio.get_running_loop()
+        while len(target.items) > 0:
+            event, msg, futures = await self._next_batch(target)
+            delay = target.last_send + self._interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            message_id = ''
+            try:
+                message_id = await send_msg(send_id, msg.to_list())
+                if hasattr(self._plugin, '__on_sent__'):
+                    self._plugin.__on_sent__(event, msg, message_id)
+            except Exception as e:
+                logger.error(f'Failed to send message to {message_type} {send_id}: {type(e).__name__}: {e}')
+            finally:
+                target.last_send = loop.time()
+                for future in futures:
+                    if not future.done():
+                        future.set_result(message_id)
+
+
+def outbound_queue(plugin: NcatBotPlugin) -> OutboundQueue:
+    '''
+    插件可以在on_load中自行创建self.outbound来配置发送参数，否则使用默认参数
+    '''
+    queue: OutboundQueue | None = getattr(plugin, 'outbound', None)
+    if queue is None:
+        queue = OutboundQueue(plugin)
+        setattr(plugin, 'outbound', queue)
+    return queue
+
+
 def hirasawa[**P](method: HirasawaMethod[P]) -> NcatBotAwaitableMethod[P]:
     '''
     method should be a async generator, or a couroutine function.
+    yielded items are sent through the plugin's OutboundQueue.
     '''
     @hirasawa_option.help('显示帮助信息')
     @flatten_args(remove=True)  # remove *args and **kwargs in signature
@@ -175,26 +337,23 @@ def hirasawa[**P](method: HirasawaMethod[P]) -> NcatBotAwaitableMethod[P]:
         self: NcatBotPlugin,
         event: MessageEventDuck, *args: P.args, **kwargs: P.kwargs) -> None:
         result = method(self, event, *args, **kwargs)
-        send_id: str
-        send_msg: Callable[[str | int, list[dict]], Awaitable[str]]
-        if event.message_type == 'group':
-            send_msg = self.api.send_group_msg_sync
-            send_id = event.group_id
-        elif event.message_type == 'private':
-            send_msg = self.api.send_private_msg_sync
-            send_id = event.user_id
-        else:
-            raise TypeError(f"Unsupported event type: {event.message_type}")
+        queue = outbound_queue(self)
         if isinstance(result, Awaitable):
             await_result: ItemType | None = await result
-            if await_result is None:
+            if await_result is None or isinstance(await_result, Flush):
                 return
-            msg = parse2array(await_result)
-            send_msg(send_id, msg.to_list())
+            await queue.put(event, parse2array(await_result))
             return
+        last_sent: asyncio.Future | None = None
         async for item in result:
-            msg = parse2array(item)
-            send_msg(send_id, msg.to_list())
+            if isinstance(item, Flush):
+                if last_sent is not None:
+                    await last_sent
+                continue
+            last_sent = queue.put(event, parse2array(item))
+        # 等本次调用yield的消息都发出去再返回
+        if last_sent is not None:
+            await last_sent
     return wrapper
 
 
@@ -0,0 +1,436 @@
+from __future__ import annotations
+
+from collections import deque
+from itertools import chain, islice
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Protocol, Sequence
+
+import asyncio
+import sqlite3
+import threading
+
+
+class MessageProtocol(Protocol):
+    '''
+    ncatbot的GroupMessage与get_group_msg_history返回的消息都满足该协议
+    '''
+    message_id: str
+    raw_message: str
+    time: int
+    @property
+    def sender(self) -> Any: ...
+
+
+class ChatRecord:
+    '''
+    一条群聊记录，用__slots__代替原来的dict，省内存也省哈希
+    '''
+    __slots__ = ('message_id', 'message', 'sender_id', 'sender_name', 'time')
+
+    def __init__(self, message_id: str, message: str, sender_id: str, sender_name: str, time: int) -> None:
+        self.message_id = message_id
+        self.message = message
+        self.sender_id = sender_id
+        self.sender_name = sender_name
+        self.time = time
+
+    @classmethod
+    def from_message(cls, message: MessageProtocol) -> ChatRecord:
+        sender = message.sender
+        return cls(
+            message_id=str(message.message_id),
+            message=message.raw_message,
+            sender_id=str(sender.user_id),
+            sender_name=sender.card if sender.card != '' else sender.nickname,
+            time=int(message.time),
+        )
+
+    def __repr__(self) -> str:
+        return f'ChatRecord({self.sender_id}: {self.message!r} @ {self.time})'
+
+
+class Streak:
+    '''
+    群里当前连续相同消息（复读）的状态，每条消息O(1)更新
+    length为当前复读的条数，joined表示bot是否已经参与了这次复读
+    当前消息打断了上一次复读时，breaker为打断者，broken_length为被打断的复读条数
+    '''
+    __slots__ = ('key', 'length', 'joined', 'breaker', 'broken_length')
+
+    def __init__(self) -> None:
+        self.key: int | None = None  # 当前消息的哈希
+        self.length = 0
+        self.joined = False
+        self.breaker: str | None = None
+        self.broken_length = 0
+
+    def push(self, record: ChatRecord, from_bot: bool) -> None:
+        key = hash(record.message)
+        if key == self.key:
+            self.length += 1
+        else:
+            self.breaker = record.sender_id
+            self.broken_length = self.length
+            self.key = key
+            self.length = 1
+            self.joined = False
+        if from_bot:
+            self.joined = True
+
+    def __repr__(self) -> str:
+        return f'Streak(length={self.length}, joined={self.joined}, broken_length={self.broken_length})'
+
+
+class GroupHistory:
+    '''
+    单个群的环形缓冲区，最多保存maxlen条聊天记录
+    最新的消息在最后，即history[-1]
+    bot_id用于判断bot是否参与了复读
+    '''
+    def __init__(self, maxlen: int, bot_id: str | None = None) -> None:
+        self._records: deque[ChatRecord] = deque(maxlen=maxlen)
+        self.bot_id = bot_id
+        self.streak = Streak()
+        self.total = 0  # 累计追加的条数，同时作为消息的序号
+        self._last_seen: dict[str, tuple[int, int]] = {}  # sender_id -> (最后一条发言的序号, 时间)
+        self.bootstrapped: bool = False
+
+    @property
+    def maxlen(self) -> int:
+        return self._records.maxlen or 0
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __iter__(self) -> Iterator[ChatRecord]:
+        return iter(self._records)
+
+    def __getitem__(self, index: int) -> ChatRecord:
+        return self._records[index]
+
+    def append(self, record: ChatRecord) -> None:
+        # bootstrap拉到的历史记录可能已经包含了当前这条消息
+        if len(self._records) > 0 and self._records[-1].message_id == record.message_id:
+            return
+        self._records.append(record)
+        self.streak.push(record, record.sender_id == self.bot_id)
+        self._last_seen[record.sender_id] = (self.total, record.time)
+        self.total += 1
+
+    def bootstrap(self, records: Iterable[ChatRecord]) -> None:
+        '''
+        用更早的历史记录填充缓冲区，已经在缓冲区里的消息不会重复添加
+        '''
+        existing = {record.message_id for record in self._records}
+        older = [record for record in records if record.message_id not in existing]
+        self._records = deque(chain(older, self._records), maxlen=self.maxlen)
+        # 更早的记录插在前面，复读状态需要从头重新计算
+        self.streak = Streak()
+        self._last_seen = {}
+        for index, record in enumerate(self._records):
+            self.streak.push(record, record.sender_id == self.bot_id)
+            self._last_seen[record.sender_id] = (index, record.time)
+        self.total = len(self._records)
+        self.bootstrapped = True
+
+    def messages_since(self, user_id: str) -> int | None:
+        '''
+        O(1)返回用户最后一次发言之后又有多少条消息，0表示最新一条就是他发的，没发过言返回None
+        '''
+        seen = self._last_seen.get(user_id)
+        if seen is None:
+            return None
+        return self.total - 1 - seen[0]
+
+    def last_time(self, user_id: str) -> int | None:
+        '''
+        O(1)返回用户最后一次发言的时间戳，没发过言返回None
+        '''
+        seen = self._last_seen.get(user_id)
+        return None if seen is None else seen[1]
+
+    def tail(self, num: int, exclude: str | None = None) -> list[ChatRecord]:
+        '''
+        返回最近的num条记录（按时间顺序），exclude为需要排除的message_id，
+        一般是触发指令的那条消息本身
+        '''
+        records: Iterable[ChatRecord] = reversed(self._records)
+        if exclude is not None:
+            records = (record for record in records if record.message_id != exclude)
+        ans = list(islice(records, num))
+        ans.reverse()
+        return ans
+
+
+class HistoryArchive:
+    '''
+    只追加的sqlite聊天记录归档，用于重启后恢复聊天记录
+    写入先攒在内存里，攒够batch_size条或者距第一条未写入的记录超过flush_interval秒后，
+    在线程里批量写入，不阻塞事件循环
+    '''
+    def __init__(self, path: Path, batch_size: int = 64, flush_interval: float = 5.0) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._lock = threading.Lock()  # sqlite连接会在不同的工作线程中使用
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._pending: list[tuple[str, str, str, str, str, int]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    group_id TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    sender_id TEXT NOT NULL,
+                    sender_name TEXT NOT NULL,
+                    time INTEGER NOT NULL,
+                    PRIMARY KEY (group_id, message_id)
+                )
+            ''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_group_time ON messages (group_id, time)')
+            self._conn.commit()
+
+    def append(self, group_id: str, record: ChatRecord) -> None:
+        '''
+        必须在事件循环中调用
+        '''
+        self._pending.append((
+            group_id,
+            record.message_id,
+            record.message,
+            record.sender_id,
+            record.sender_name,
+            record.time,
+        ))
+        if len(self._pending) >= self._batch_size:
+            self._spawn_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self._flush_interval, self._spawn_flush)
+
+    def _spawn_flush(self) -> None:
+        task = asyncio.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if len(self._pending) == 0:
+            return
+        rows, self._pending = self._pending, []
+        await asyncio.to_thread(self._write, rows)
+
+    def _write(self, rows: list[tuple[str, str, str, str, str, int]]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?)',
+                rows,
+            )
+            self._conn.commit()
+
+    def _query(self, sql: str, params: tuple) -> list[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    async def _records(self, sql: str, params: tuple) -> list[ChatRecord]:
+        await self.flush()  # 保证查询结果包含还没落盘的记录
+        rows = await asyncio.to_thread(self._query, sql, params)
+        rows.reverse()  # 查询按时间倒序取最近的，返回时按时间顺序
+        return [ChatRecord(*row) for row in rows]
+
+    async def groups(self) -> list[str]:
+        await self.flush()
+        rows = await asyncio.to_thread(self._query, 'SELECT DISTINCT group_id FROM messages', ())
+        return [row[0] for row in rows]
+
+    async def recent(self, group_id: str, num: int) -> list[ChatRecord]:
+        '''
+        本群最近的num条消息
+        '''
+        return await self._records(
+            'SELECT message_id, message, sender_id, sender_name, time FROM messages '
+            'WHERE group_id = ? ORDER BY time DESC, rowid DESC LIMIT ?',
+            (group_id, num),
+        )
+
+    async def close(self) -> None:
+        await self.flush()
+        with self._lock:
+            self._conn.close()
+
+
+class HistoryStore(dict[str, GroupHistory]):
+    '''
+    group_id -> GroupHistory，访问不存在的群时自动创建空的缓冲区
+    '''
+    def __init__(self, maxlen: int, bot_id: str | None = None) -> None:
+        super().__init__()
+        self.maxlen = maxlen
+        self.bot_id = bot_id
+
+    def __missing__(self, group_id: str) -> GroupHistory:
+        history = GroupHistory(self.maxlen, self.bot_id)
+        self[group_id] = history
+        return history
+
+
+def is_command(record: ChatRecord) -> bool:
+    return record.message.lstrip().startswith('/')
+
+
+def conversation_anchor(records: Iterable[ChatRecord], bot_id: str | None = None) -> str:
+    '''
+    最后一条群友发言（不是指令调用，也不是bot发的）的message_id，没有时返回空字符串
+    指令调用、bot的"少女xx中…"回显与ai回复都不会改变它，群里没有新的发言时重复的请求得到同一个值
+    '''
+    for record in reversed(list(records)):
+        if record.sender_id != bot_id and not is_command(record):
+            return record.message_id
+    return ''
+
+
+def estimate_tokens(text: str) -> int:
+    '''
+    粗略估计token数：汉字等非ASCII字符按1个token算，ASCII字符按4个一个token算
+    '''
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return len(text) - ascii_chars + (ascii_chars + 3) // 4
+
+
+def _alias(index: int) -> str:
+    letter = chr(ord('A') + index % 26)
+    return letter if index < 26 else f'{letter}{index // 26}'
+
+
+def _relative_time(seconds: int) -> str:
+    if seconds < 60:
+        return '刚刚'
+    if seconds < 3600:
+        return f'{seconds // 60}分钟前'
+    return f'{seconds // 3600}小时前'
+
+
+class _Entry:
+    __slots__ = ('message', 'sender_ids', 'count', 'time')
+
+    def __init__(self, record: ChatRecord, message: str) -> None:
+        self.message = message
+        self.sender_ids = [record.sender_id]
+        self.count = 1
+        self.time = record.time
+
+
+class CompactHistory:
+    '''
+    压缩后的聊天记录，text形如：
+    ```
+    A=1294702887(平沢原)
+    B=3347891234(平沢bot)
+
+    [5分钟前] A: 你好
+    B: Ciallo～
+    [刚刚] A,B: 哈哈哈 ×3
+    ```
+    发言者用代号表示，时间只在与上一行不同时标注，连续相同的消息合并并标注次数
+    '''
+    def __init__(self, header: list[str], lines: list[str], aliases: dict[str, str] | None = None) -> None:
+        self.header = header
+        self.lines = lines
+        self.aliases = aliases or {}  # sender_id -> 代号，只包含压缩后仍然保留的发言者
+
+    def has_talked(self, user_id: str) -> bool:
+        '''
+        用户的发言是否出现在压缩后的聊天记录中，即ai实际能看到的范围
+        '''
+        return user_id in self.aliases
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    @property
+    def text(self) -> str:
+        return '\n'.join(self.header) + '\n\n' + '\n'.join(self.lines)
+
+    @property
+    def tokens(self) -> int:
+        return estimate_tokens(self.text)
+
+
+def compact_history(
+    records: Sequence[ChatRecord],
+    budget: int = 2000,
+    bot_id: str | None = None,
+    max_message_length: int = 200,
+) -> CompactHistory:
+    '''
+    把聊天记录压缩成CompactHistory，估计的token数不超过budget，超出时丢弃最早的消息
+    会丢弃指令调用（以'/'开头）及bot对指令的输出（例如"少女解析笑点中…"与ai回复）、bot复读别人的消息，
+    并合并连续相同的消息（例如表情包接龙）
+    '''
+    entries: list[_Entry] = []
+    seen: set[str] = set()
+    answering = False  # 上一条群友的消息是指令，bot接下来发的都是指令的输出
+    for record in records:
+        if record.sender_id == bot_id:
+            if answering:
+                continue
+        else:
+            answering = is_command(record)
+        message = record.message.strip()
+        if message == '' or is_command(record):
+            continue
+        if len(message) > max_message_length:
+            message = message[:max_message_length] + '…'
+        if len(entries) > 0 and entries[-1].message == message:
+            entry = entries[-1]
+            entry.count += 1
+            entry.time = record.time
+            if record.sender_id not in entry.sender_ids:
+                entry.sender_ids.append(record.sender_id)
+            continue
+        if record.sender_id == bot_id and message in seen:
+            continue
+        seen.add(message)
+        entries.append(_Entry(record, message))
+    names = {record.sender_id: record.sender_name for record in records}
+    # 从最新的消息往前取，直到用完预算
+    kept: list[_Entry] = []
+    senders: set[str] = set()
+    used = 0
+    for entry in reversed(entries):
+        # 代号与时间标注按最长的情况估计
+        cost = estimate_tokens(entry.message) + 4 * len(entry.sender_ids) + 6
+        for sender_id in entry.sender_ids:
+            if sender_id not in senders:
+                cost += estimate_tokens(f'A1={sender_id}({names[sender_id]})')
+        if used + cost > budget:
+            break
+        used += cost
+        senders.update(entry.sender_ids)
+        kept.append(entry)
+    kept.reverse()
+    aliases: dict[str, str] = {}
+    header: list[str] = []
+    lines: list[str] = []
+    last_time = ''
+    now = kept[-1].time if len(kept) > 0 else 0
+    for entry in kept:
+        for sender_id in entry.sender_ids:
+            if sender_id in aliases:
+                continue
+            aliases[sender_id] = _alias(len(aliases))
+            header.append(f'{aliases[sender_id]}={sender_id}({names[sender_id]})')
+        line = f"{','.join(aliases[s] for s in entry.sender_ids)}: {entry.message}"
+        if entry.count > 1:
+            line += f' ×{entry.count}'
+        relative_time = _relative_time(now - entry.time)
+        if relative_time != last_time:
+            line = f'[{relative_time}] {line}'
+            last_time = relative_time
+        lines.append(line)
+    return CompactHistory(header, lines, aliases)
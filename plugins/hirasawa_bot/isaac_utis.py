@@ -1,66 +1,311 @@
+from __future__ import annotations
+
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from enum import IntEnum
 from pathlib import Path
+from typing import Iterator, Mapping, Sequence
+import hashlib
+import math
+import os
+import pickle
 import re
 
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from ncatbot.utils import get_log
+
+from file_utils import atomic_write
+
+from .trigger_utils import to_pinyin
+
+
+logger = get_log()
+
+
+EID_CACHE_VERSION = 2  # 解析逻辑或缓存格式变化时加一，旧缓存自动作废
+
+
+class IconIndex:
+    '''
+    EID图标索引：icon目录下的图标按文件名索引，道具与饰品图片按id索引
+    查找只是一次dict查询，refresh时目录的mtime变了才重新扫描
+    '''
+    ITEM_PREFIXES = {'Collectible': 'collectibles', 'Trinket': 'trinkets'}
+
+    def __init__(self, isaac_root: Path) -> None:
+        self.isaac_root = isaac_root
+        self._dirs = [isaac_root / 'icon', *(isaac_root / 'items' / d for d in self.ITEM_PREFIXES.values())]
+        self._mtimes: list[int | None] = []
+        self._icons: dict[str, Path] = {}
+        self._items: dict[str, dict[int, Path]] = {}
+        self.refresh()
+
+    def _scan(self) -> None:
+        icon_root = self._dirs[0]
+        self._icons = {
+            icon.stem: icon
+            for icon in (icon_root.iterdir() if icon_root.is_dir() else [])
+            if icon.suffix == '.png'
+        }
+        self._items = {}
+        for prefix, item_type in self.ITEM_PREFIXES.items():
+            items = self._items[prefix] = {}
+            item_root = self.isaac_root / 'items' / item_type
+            for image in (item_root.iterdir() if item_root.is_dir() else []):
+                if image.suffix != '.png': continue
+                try:
+                    items[int(image.stem.split('_')[1])] = image
+                except (IndexError, ValueError):
+                    continue
+
+    def refresh(self) -> None:
+        mtimes = [d.stat().st_mtime_ns if d.is_dir() else None for d in self._dirs]
+        if mtimes != self._mtimes:
+            self._scan()
+            self._mtimes = mtimes
+
+    def get(self, name: str) -> Path | None:
+        '''
+        Collectible118、Trinket1之类优先找道具图片，其余在icon目录中找同名图标
+        '''
+        for prefix in self.ITEM_PREFIXES:
+            if name.startswith(prefix) and len(name) > len(prefix):
+                try:
+                    item_id = int(name[len(prefix):])
+                except ValueError:
+                    break
+                icon = self._items[prefix].get(item_id)
+                if icon is not None:
+                    return icon
+                break
+        return self._icons.get(name)
+
+
+_icon_indexes: dict[Path, IconIndex] = {}
+
 
 def get_icon(name: str, isaac_root: Path) -> Path | None:
-    icon = isaac_root / 'icon' / f'{name}.png'
-    if name.startswith('Collectible') and len(name) > len('Collectible'):
-        collectibles_root = isaac_root / 'items' / 'collectibles'
-        for collectible in collectibles_root.iterdir():
-            if collectible.suffix != '.png': continue
-            if int(collectible.stem.split('_')[1]) == int(name[len('Collectible'):]):
-                icon = collectible
-    if name.startswith('Trinket') and len(name) > len('Trinket'):
-        trinkets_root = isaac_root / 'items' / 'trinkets'
-        for trinket in trinkets_root.iterdir():
-            if trinket.suffix != '.png': continue
-            if int(trinket.stem.split('_')[1]) == int(name[len('Trinket'):]):
-                icon = trinket
-    if icon.exists():
-        return icon
-    return None
-
-
-def load_eid(item_type: str, isaac_root: Path, lang: str = 'zh_cn') -> dict[int, dict]:
+    index = _icon_indexes.get(isaac_root)
+    if index is None:
+        index = _icon_indexes[isaac_root] = IconIndex(isaac_root)
+    else:
+        index.refresh()
+    return index.get(name)
+
+
+def _eid_sources(item_type: str, isaac_root: Path, lang: str) -> dict[str, int]:
+    '''
+    缓存依赖的源文件及其mtime，图片目录的mtime在增删改名文件时会变化
+    '''
+    sources = [
+        isaac_root / 'eid' / lang / f'{item_type}.luapy',
+        isaac_root / 'items' / item_type,
+    ]
+    return {str(path): path.stat().st_mtime_ns for path in sources}
+
+
+def load_eid(item_type: str, isaac_root: Path, lang: str = 'zh_cn', cache: bool = True) -> dict[int, dict]:
+    '''
+    读取解析好的EID数据，结果以pickle缓存在isaac_root/.cache下
+    只有luapy文件或图片目录的mtime变化时才重新解析
+    '''
+    if not cache:
+        return parse_eid(item_type, isaac_root, lang)
+    cache_path = isaac_root / '.cache' / f'eid_{lang}_{item_type}.pickle'
+    sources = _eid_sources(item_type, isaac_root, lang)
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['version'] == EID_CACHE_VERSION and cached['sources'] == sources:
+            return cached['data']
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError, AttributeError):
+        pass
+    ans = parse_eid(item_type, isaac_root, lang)
+    # 先写临时文件再替换，避免进程中途退出留下损坏的缓存
+    with atomic_write(cache_path) as tmp_path, open(tmp_path, 'wb') as f:
+        pickle.dump(
+            {'version': EID_CACHE_VERSION, 'sources': sources, 'data': ans},
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    return ans
+
+
+class LuapyError(ValueError):
+    def __init__(self, path: Path | str, lineno: int, reason: str) -> None:
+        super().__init__(f'{path}:{lineno}: {reason}')
+        self.path = path
+        self.lineno = lineno
+        self.reason = reason
+
+
+_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '\\': '\\', '"': '"', "'": "'"}
+_NUMBER = re.compile(r'-?\d+(?:\.\d+)?')
+# 字符串中不需要特殊处理的连续字符，整段切片而不是逐字符处理
+_PLAIN = {'"': re.compile(r'[^"\\]*'), "'": re.compile(r"[^'\\]*")}
+
+
+class _LuapyLine:
+    '''
+    单行luapy的递归下降解析器，只支持 [数字] = {字符串或数字, ...}, -- 注释 这种形式
+    '''
+    __slots__ = ('text', 'pos')
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.pos = 0
+
+    def peek(self) -> str:
+        return self.text[self.pos] if self.pos < len(self.text) else ''
+
+    def skip_space(self) -> None:
+        while self.pos < len(self.text) and self.text[self.pos] in ' \t\r':
+            self.pos += 1
+
+    def expect(self, char: str) -> None:
+        self.skip_space()
+        if self.peek() != char:
+            found = repr(self.peek()) if self.peek() else 'end of line'
+            raise ValueError(f"expected {char!r} at column {self.pos + 1}, found {found}")
+        self.pos += 1
+
+    def at_end(self) -> bool:
+        self.skip_space()
+        return self.pos >= len(self.text) or self.text.startswith('--', self.pos)
+
+    def string(self) -> str:
+        quote = self.peek()
+        plain = _PLAIN[quote]
+        self.pos += 1
+        chars: list[str] = []
+        while True:
+            end = plain.match(self.text, self.pos).end()  # type: ignore[union-attr]
+            chars.append(self.text[self.pos:end])
+            self.pos = end + 1
+            if end >= len(self.text):
+                raise ValueError('unterminated string')
+            if self.text[end] == quote:
+                return ''.join(chars)
+            if self.pos >= len(self.text):  # 行尾的反斜杠
+                raise ValueError('unterminated string')
+            escaped = self.text[self.pos]
+            self.pos += 1
+            chars.append(_ESCAPES.get(escaped, escaped))
+
+    def number(self) -> int | float:
+        match = _NUMBER.match(self.text, self.pos)
+        if match is None:
+            raise ValueError(f'unexpected {self.peek()!r} at column {self.pos + 1}')
+        self.pos = match.end()
+        value = match.group()
+        return float(value) if '.' in value else int(value)
+
+    def value(self) -> str | int | float:
+        self.skip_space()
+        if self.peek() in ('"', "'"):
+            return self.string()
+        return self.number()
+
+    def table(self) -> list[str | int | float]:
+        self.expect('{')
+        fields: list[str | int | float] = []
+        self.skip_space()
+        if self.peek() == '}':
+            self.pos += 1
+            return fields
+        while True:
+            fields.append(self.value())
+            self.skip_space()
+            if self.peek() == ',':
+                self.pos += 1
+                self.skip_space()
+                if self.peek() == '}':  # 允许末尾多一个逗号
+                    self.pos += 1
+                    return fields
+                continue
+            self.expect('}')
+            return fields
+
+    def entry(self) -> list[str | int | float] | None:
+        '''
+        不是条目的行（注释、空行、EID.xxx = {、单独的{或}等）返回None，格式错误的条目抛出ValueError
+        '''
+        self.skip_space()
+        if self.at_end() or self.peek() not in ('{', '['):
+            return None
+        if self.peek() == '[':
+            self.pos += 1
+            self.value()
+            self.expect(']')
+            self.expect('=')
+            self.skip_space()
+        # 只有一个{的行（包括[1] = {）是表的开头，内容在后面的行里
+        start = self.pos
+        self.expect('{')
+        if self.at_end():
+            return None
+        self.pos = start
+        fields = self.table()
+        self.skip_space()
+        if self.peek() == ',':
+            self.pos += 1
+        if not self.at_end():
+            raise ValueError(f'unexpected {self.peek()!r} at column {self.pos + 1}')
+        return fields
+
+
+def iter_luapy(path: Path, errors: list[LuapyError] | None = None) -> Iterator[tuple[int, list[str | int | float]]]:
+    '''
+    逐行读取luapy文件，yield (行号, 字段列表)
+    errors不为None时，格式错误的行记录到errors中并跳过，否则抛出LuapyError
+    '''
+    with open(path, 'r', encoding='utf-8') as f:
+        for lineno, line in enumerate(f, 1):
+            try:
+                fields = _LuapyLine(line.rstrip('\n')).entry()
+            except ValueError as e:
+                error = LuapyError(path, lineno, str(e))
+                if errors is None:
+                    raise error from None
+                errors.append(error)
+                continue
+            if fields is not None:
+                yield lineno, fields
+
+
+def parse_eid(
+    item_type: str,
+    isaac_root: Path,
+    lang: str = 'zh_cn',
+    errors: list[LuapyError] | None = None,
+) -> dict[int, dict]:
     '''
     luapy并不是一种语言，只是一种用类json格式储存的lua数据的字符文件
     以方便我用python解析
+    格式错误的行会记录到errors中（不传则只打日志），不会中断解析
     '''
     luapy_path = isaac_root / 'eid' / lang / f'{item_type}.luapy'
     ans: dict[int, dict] = {}
-    with open(luapy_path, 'r', encoding='utf-8') as f:
-        content = f.read()
-    for line in content.split('\n'):
-        parts = line.split('--')
-        line = parts[0] if len(parts) == 1 else '--'.join(parts[:-1])
-        line = line.strip()
-        if line.endswith(','): line = line[:-1]
-
-        if line.startswith('{') and line.endswith('}'):
-            line = f'[{line[1:-1]}]'
-            try:
-                item = eval(line)
-                key = int(item[0])
-                ans[key] = {}
-                ans[key]['id'] = item[0]  # key is int, 'id' is str
-                ans[key]['name'] = item[1]
-                ans[key]['desc'] = item[2]
-            except:
-                continue
-        elif line.startswith('['):
-            line = ('='.join(line.split('=')[1:])).strip()
-            line = f'[{line[1:-1]}]'
-            try:
-                item = eval(line)
-                key = int(item[0])
-                ans[key] = {}
-                ans[key]['id'] = item[0]  # key is int, 'id' is str
-                ans[key]['name'] = item[1]
-                ans[key]['desc'] = item[2]
-            except:
-                continue  
-        else:
+    collected: list[LuapyError] = [] if errors is None else errors
+    for lineno, item in iter_luapy(luapy_path, collected):
+        if len(item) < 3:
+            collected.append(LuapyError(luapy_path, lineno, f'expected at least 3 fields, got {len(item)}'))
+            continue
+        try:
+            key = int(item[0])
+        except ValueError:
+            collected.append(LuapyError(luapy_path, lineno, f'invalid id {item[0]!r}'))
             continue
+        ans[key] = {}
+        ans[key]['id'] = str(item[0])  # key is int, 'id' is str
+        ans[key]['name'] = item[1]
+        ans[key]['desc'] = item[2]
+    if errors is None:
+        for error in collected:
+            logger.warning(f'Malformed EID entry: {error}')
     image_root = isaac_root / 'items' / item_type
     for image in image_root.iterdir():
         if image.suffix != '.png': continue
@@ -71,7 +316,16 @@ def load_eid(item_type: str, isaac_root: Path, lang: str = 'zh_cn') -> dict[int,
     return ans
 
 
-def eid_description(item_type: str, isaac_root: Path, info: dict[str, str], no_desc: bool = False) -> list[str | Path]:    
+def eid_description(
+    item_type: str,
+    isaac_root: Path,
+    info: dict[str, str],
+    no_desc: bool = False,
+    icons: IconIndex | None = None,
+) -> list[str | Path]:
+    '''
+    icons为load时建好的图标索引，不传时使用get_icon
+    '''
     item_type = item_type.lower()
     name = info['name']
     desc = info['desc']
@@ -83,6 +337,8 @@ def eid_description(item_type: str, isaac_root: Path, info: dict[str, str], no_d
     desc = desc.replace('#', '\n')
     desc = desc.replace('↓', '{{ArrowDown}}')
     desc = desc.replace('↑', '{{ArrowUp}}')
+    if icons is not None:
+        icons.refresh()
     arr: list[str | Path] = [image_file]
     for seg in re.split(
         r'(\{\{.*?\}\})', 
@@ -91,7 +347,7 @@ def eid_description(item_type: str, isaac_root: Path, info: dict[str, str], no_d
         if not seg.startswith('{{'):
             arr.append(seg)
             continue
-        icon = get_icon(seg[2:-2], isaac_root)
+        icon = icons.get(seg[2:-2]) if icons is not None else get_icon(seg[2:-2], isaac_root)
         if icon is None:
             arr.append(seg)
             continue
@@ -99,4 +355,389 @@ def eid_description(item_type: str, isaac_root: Path, info: dict[str, str], no_d
             arr[-1] = icon
         else:
             arr.append(icon)
-    return arr
\ No newline at end of file
+    return arr
+
+
+class MatchRank(IntEnum):
+    EXACT = 0
+    PREFIX = 1
+    SUBSTRING = 2
+    FUZZY = 3
+
+
+@dataclass(frozen=True, slots=True)
+class SearchHit:
+    item_type: str  # 'collectibles' 或 'trinkets'
+    item_id: int
+    name: str
+    rank: MatchRank
+    score: float  # 同一rank内越小越靠前
+
+    @property
+    def code(self) -> str:
+        return f"{'C' if self.item_type == 'collectibles' else 'T'}{self.item_id}"
+
+
+def _search_keys(name: str) -> tuple[str, ...]:
+    '''
+    名称本身、全拼、拼音首字母，都去掉空白并转小写
+    '''
+    name = ''.join(name.split()).lower()
+    syllables = [s if s is not None else c for c, s in zip(name, to_pinyin(name))]
+    return name, ''.join(syllables), ''.join(s[0] for s in syllables)
+
+
+def _grams(key: str) -> set[str]:
+    if len(key) < 2:
+        return {key} if key else set()
+    return {key[i:i + 2] for i in range(len(key) - 1)}
+
+
+class IsaacSearchIndex:
+    '''
+    道具/饰品名称检索，支持中文、全拼与拼音首字母，例如'妈妈的菜刀'、'caidao'、'mmdcd'
+    名称与拼音按字符构建1-gram与2-gram倒排索引，结果按 完全匹配 > 前缀 > 子串 > 模糊 排序
+    '''
+    def __init__(self, items: Mapping[str, Mapping[int, dict]]) -> None:
+        self._entries: list[tuple[str, int, str, tuple[str, ...]]] = []
+        self._unigrams: dict[str, set[int]] = {}
+        self._bigrams: dict[str, set[int]] = {}
+        for item_type, infos in items.items():
+            for item_id, info in infos.items():
+                index = len(self._entries)
+                keys = _search_keys(info['name'])
+                self._entries.append((item_type, item_id, info['name'], keys))
+                for key in keys:
+                    for char in key:
+                        self._unigrams.setdefault(char, set()).add(index)
+                    for gram in _grams(key):
+                        if len(gram) == 2:
+                            self._bigrams.setdefault(gram, set()).add(index)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _candidates(self, query: str) -> set[int]:
+        '''
+        返回包含查询全部n-gram的条目，子串匹配一定在其中
+        '''
+        postings = self._unigrams if len(query) < 2 else self._bigrams
+        candidates: set[int] | None = None
+        for gram in sorted(_grams(query), key=lambda gram: len(postings.get(gram, ()))):
+            posting = postings.get(gram)
+            if not posting:
+                return set()
+            candidates = set(posting) if candidates is None else candidates & posting
+        return candidates or set()
+
+    def _fuzzy(self, query: str) -> list[SearchHit]:
+        '''
+        按重合度模糊匹配：至少包含查询中一半的字（拼音查询按2-gram算），按缺少的比例排序
+        '''
+        if query.isascii():
+            # 拼音字母太常见，单个字母的重合没有意义
+            chars, postings = _grams(query), self._bigrams
+        else:
+            chars, postings = set(query), self._unigrams
+        overlap: Counter[int] = Counter()
+        for char in chars:
+            overlap.update(postings.get(char, ()))
+        hits = []
+        for index, count in overlap.items():
+            if count * 2 < len(chars):
+                continue
+            item_type, item_id, name, _ = self._entries[index]
+            hits.append(SearchHit(item_type, item_id, name, MatchRank.FUZZY, 1 - count / len(chars)))
+        return hits
+
+    def search(self, query: str, top_k: int = 5) -> list[SearchHit]:
+        query = ''.join(query.split()).lower()
+        if not query:
+            return []
+        hits: list[SearchHit] = []
+        for index in self._candidates(query):
+            item_type, item_id, name, keys = self._entries[index]
+            best: tuple[MatchRank, float] | None = None
+            for key in keys:
+                if key == query:
+                    rank = MatchRank.EXACT
+                elif key.startswith(query):
+                    rank = MatchRank.PREFIX
+                elif query in key:
+                    rank = MatchRank.SUBSTRING
+                else:
+                    continue
+                # 越短的名称与查询越接近
+                candidate = (rank, len(key) - len(query))
+                if best is None or candidate < best:
+                    best = candidate
+            if best is not None:
+                hits.append(SearchHit(item_type, item_id, name, *best))
+        if not hits:
+            hits = self._fuzzy(query)
+        hits.sort(key=lambda hit: (hit.rank, hit.score, hit.item_type, hit.item_id))
+        return hits[:top_k]
+
+
+ITEM_TYPES = ('collectibles', 'trinkets')
+
+
+@dataclass
+class EIDPack:
+    '''
+    一个语言的全部EID数据以及对应的名称检索索引
+    '''
+    lang: str
+    items: dict[str, dict[int, dict]]  # item_type -> item_id -> info
+    search: IsaacSearchIndex
+
+    @classmethod
+    def load(cls, isaac_root: Path, lang: str) -> EIDPack:
+        items = {item_type: load_eid(item_type, isaac_root, lang) for item_type in ITEM_TYPES}
+        return cls(lang, items, IsaacSearchIndex(items))
+
+
+class EIDLibrary:
+    '''
+    按语言懒加载EID数据包，第一次用到某个语言时才读取
+    最多同时保存max_packs个语言，最久没用的先释放
+    某个语言缺少条目时按fallback链查找，例如fallback={'en_us': ['zh_cn']}，最后总会回落到default_lang
+    '''
+    def __init__(
+        self,
+        isaac_root: Path,
+        default_lang: str = 'zh_cn',
+        fallback: Mapping[str, Sequence[str]] | None = None,
+        max_packs: int = 2,
+    ) -> None:
+        self.isaac_root = isaac_root
+        self.default_lang = default_lang
+        self.fallback = dict(fallback or {})
+        self.max_packs = max(1, max_packs)
+        eid_root = isaac_root / 'eid'
+        self.languages = sorted(d.name for d in eid_root.iterdir() if d.is_dir()) if eid_root.is_dir() else []
+        self._packs: OrderedDict[str, EIDPack] = OrderedDict()
+
+    def pack(self, lang: str) -> EIDPack:
+        pack = self._packs.get(lang)
+        if pack is not None:
+            self._packs.move_to_end(lang)
+            return pack
+        if lang not in self.languages:
+            raise KeyError(f'Unknown EID language: {lang}')
+        pack = self._packs[lang] = EIDPack.load(self.isaac_root, lang)
+        while len(self._packs) > self.max_packs:
+            self._packs.popitem(last=False)
+        return pack
+
+    def chain(self, lang: str | None) -> list[str]:
+        langs = [lang or self.default_lang, *self.fallback.get(lang or self.default_lang, ()), self.default_lang]
+        return [l for l in dict.fromkeys(langs) if l in self.languages]
+
+    def get(self, item_type: str, item_id: int, lang: str | None = None) -> dict | None:
+        for l in self.chain(lang):
+            info = self.pack(l).items[item_type].get(item_id)
+            if info is not None:
+                return info
+        return None
+
+    def search(self, query: str, lang: str | None = None, top_k: int = 5) -> tuple[EIDPack | None, list[SearchHit]]:
+        '''
+        在fallback链上第一个有结果的语言中检索，返回该语言的数据包与检索结果
+        '''
+        for l in self.chain(lang):
+            pack = self.pack(l)
+            hits = pack.search.search(query, top_k=top_k)
+            if len(hits) > 0:
+                return pack, hits
+        return None, []
+
+
+# 没有配置字体时依次尝试的系统中文字体
+_CJK_FONTS = (
+    '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/truetype/wqy/wqy-microhei.ttc',
+    '/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc',
+    '/usr/share/fonts/wenquanyi/wqy-microhei/wqy-microhei.ttc',
+    'C:/Windows/Fonts/msyh.ttc',
+    'C:/Windows/Fonts/simhei.ttf',
+    '/System/Library/Fonts/PingFang.ttc',
+    '/System/Library/Fonts/STHeiti Medium.ttc',
+)
+
+
+class _TextPainter:
+    '''
+    用Pillow绘制文字，font为None时使用系统中的中文字体
+    找不到中文字体时退回Pillow自带的字体，只能绘制ASCII字符
+    '''
+    def __init__(self, font: Path | None, size: int) -> None:
+        self.size = size
+        self.font_path = font if font is not None else next((Path(f) for f in _CJK_FONTS if Path(f).exists()), None)
+        self.cjk = self.font_path is not None
+        self._font: ImageFont.FreeTypeFont | ImageFont.ImageFont
+        if self.font_path is not None:
+            self._font = ImageFont.truetype(str(self.font_path), size)
+        else:
+            logger.warning('No CJK font found for EID cards, non-ASCII descriptions fall back to plain messages')
+            self._font = ImageFont.load_default(size)
+
+    def supports(self, text: str) -> bool:
+        return self.cjk or text.isascii()
+
+    def width(self, text: str) -> int:
+        return int(math.ceil(self._font.getlength(text)))
+
+    def draw(self, draw: ImageDraw.ImageDraw, text: str, x: int, top: int, color: tuple[int, int, int]) -> None:
+        draw.text((x, top), text, font=self._font, fill=color)
+
+
+def _paste(canvas: np.ndarray, image: np.ndarray, x: int, y: int) -> None:
+    '''
+    把图片贴到canvas上，带透明通道时做alpha混合
+    '''
+    h = min(image.shape[0], canvas.shape[0] - y)
+    w = min(image.shape[1], canvas.shape[1] - x)
+    if h <= 0 or w <= 0:
+        return
+    image = image[:h, :w]
+    region = canvas[y:y + h, x:x + w]
+    if image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    if image.shape[2] == 4:
+        alpha = image[:, :, 3:4].astype(np.float32) / 255
+        region[:] = (image[:, :, :3] * alpha + region * (1 - alpha)).astype(np.uint8)
+    else:
+        region[:] = image[:, :, :3]
+
+
+# 按词切分：连续的ASCII字母数字作为一个整体，其余字符单独一个
+_TOKENS = re.compile(r'\n|[A-Za-z0-9.,+\-%/:()]+|\s|.')
+
+
+class EIDCardRenderer:
+    '''
+    把eid_description的结果（道具图片、名称、id、描述与内嵌图标）画成一张卡片
+    卡片按(道具, 语言, no_desc)与内容摘要缓存在cache_root下，同一道具第二次请求直接返回文件
+    同一道具内容变化后旧的卡片会被删除，卡片总数超过max_cards时删除最久没用过的
+    无法绘制（例如找不到中文字体却含有中文）时返回None，调用方应退回原来的图文消息
+    '''
+    VERSION = 2  # 排版变化时加一，旧卡片自动作废
+    BACKGROUND = (38, 34, 30)  # BGR
+    FOREGROUND = (235, 235, 235)
+
+    def __init__(
+        self,
+        cache_root: Path,
+        font: Path | None = None,
+        width: int = 640,
+        font_size: int = 22,
+        max_cards: int = 1024,
+    ) -> None:
+        self.cache_root = cache_root
+        self.width = width
+        self.max_cards = max_cards
+        self.padding = font_size
+        self.line_height = font_size * 3 // 2
+        self._painter = _TextPainter(font, font_size)
+
+    def _cache_path(self, key: str, segments: Sequence[str | Path]) -> Path:
+        digest = hashlib.sha1(repr((self.VERSION, self.width, list(map(str, segments)))).encode('utf-8')).hexdigest()
+        return self.cache_root / f'{key}_{digest[:12]}.png'
+
+    def _layout(self, segments: Sequence[str | Path], top: int) -> tuple[list[tuple[int, int, str | Path]], int]:
+        '''
+        从上往下排版，返回(x, y, 文本或图标)列表与总高度
+        '''
+        ops: list[tuple[int, int, str | Path]] = []
+        x, y = self.padding, top
+        right = self.width - self.padding
+        for seg in segments:
+            tokens: list[str | Path] = [seg] if isinstance(seg, Path) else _TOKENS.findall(seg)
+            for token in tokens:
+                if token == '\n':
+                    x, y = self.padding, y + self.line_height
+                    continue
+                width = self.line_height if isinstance(token, Path) else self._painter.width(token)
+                if x + width > right and x > self.padding:
+                    x, y = self.padding, y + self.line_height
+                    if isinstance(token, str) and token.isspace():
+                        continue
+                ops.append((x, y, token))
+                x += width
+        return ops, y + self.line_height + self.padding
+
+    def render(self, segments: Sequence[str | Path], key: str) -> Path | None:
+        '''
+        segments为eid_description的返回值，第一个元素是道具图片
+        '''
+        cache_path = self._cache_path(key, segments)
+        if cache_path.exists():
+            os.utime(cache_path)  # 记录最近使用时间，清理时按它排序
+            return cache_path
+        if not all(self._painter.supports(seg) for seg in segments if isinstance(seg, str)):
+            return None
+        image_file, *body = segments
+        item_image = cv2.imread(str(image_file), cv2.IMREAD_UNCHANGED)
+        top = self.padding
+        if item_image is not None:
+            # 道具图片是像素画，放大时用最近邻插值保持清晰
+            scale = max(1, 96 // max(item_image.shape[:2]))
+            item_image = cv2.resize(item_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST)
+            top += item_image.shape[0] + self.padding // 2
+        ops, height = self._layout(body, top)
+        canvas = np.full((height, self.width, 3), self.BACKGROUND, dtype=np.uint8)
+        if item_image is not None:
+            _paste(canvas, item_image, self.padding, self.padding)
+        icons: dict[Path, np.ndarray | None] = {}
+        for x, y, token in ops:
+            if isinstance(token, str):
+                continue
+            if token not in icons:
+                icon = cv2.imread(str(token), cv2.IMREAD_UNCHANGED)
+                if icon is not None:
+                    size = self.line_height - 4
+                    icon = cv2.resize(icon, (size, size), interpolation=cv2.INTER_NEAREST)
+                icons[token] = icon
+            if (icon := icons[token]) is not None:
+                _paste(canvas, icon, x, y + 2)
+        # 图片用opencv贴好后，再转成Pillow的图片一次性画上所有文字
+        image = Image.fromarray(cv2.cvtColor(canvas, cv2.COLOR_BGR2RGB))
+        draw = ImageDraw.Draw(image)
+        color = self.FOREGROUND[::-1]
+        for x, y, token in ops:
+            if isinstance(token, str) and not token.isspace():
+                self._painter.draw(draw, token, x, y, color)
+        with atomic_write(cache_path, suffix='.tmp.png') as tmp_path:
+            image.save(tmp_path)
+        self.prune(key, keep=cache_path)
+        return cache_path
+
+    def prune(self, key: str | None = None, keep: Path | None = None) -> int:
+        '''
+        删除key的旧卡片（内容或排版变化前生成的），再按最近使用时间把卡片总数删到max_cards以内
+        返回删除的文件数
+        '''
+        if not self.cache_root.is_dir():
+            return 0
+        removed = 0
+        cards: list[tuple[float, Path]] = []
+        for path in self.cache_root.glob('*.png'):
+            if path == keep or path.name.endswith('.tmp.png'):
+                continue
+            if key is not None and path.name.startswith(f'{key}_'):
+                path.unlink(missing_ok=True)
+                removed += 1
+                continue
+            try:
+                cards.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                continue
+        cards.sort()
+        excess = len(cards) + (keep is not None) - self.max_cards
+        for _, path in cards[:max(0, excess)]:
+            path.unlink(missing_ok=True)
+            removed += 1
+        return removed
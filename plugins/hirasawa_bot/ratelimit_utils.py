@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any, Callable, Mapping
+
+import asyncio
+import time
+
+
+class RateLimitExceeded(Exception):
+    '''
+    scope为触发限流的维度（'group'、'user'、'provider'），retry_after为需要等待的秒数
+    '''
+    def __init__(self, scope: str, key: str, retry_after: float) -> None:
+        super().__init__(f"Rate limited by {scope} '{key}', retry after {retry_after:.1f}s")
+        self.scope = scope
+        self.key = key
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    '''
+    令牌桶，最多存capacity个令牌，每秒补充rate个令牌
+    clock返回单调递增的秒数，测试时可以替换
+    '''
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated', 'clock')
+
+    def __init__(self, capacity: float, rate: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self, now: float) -> None:
+        if now <= self.updated:
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self, cost: float = 1.0, now: float | None = None) -> float:
+        '''
+        返回还需要等待多少秒才有cost个令牌，0表示现在就可以取
+        '''
+        self._refill(now if now is not None else self.clock())
+        if self.tokens >= cost:
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost: float = 1.0) -> None:
+        self.tokens -= cost
+
+    @property
+    def full(self) -> bool:
+        self._refill(self.clock())
+        return self.tokens >= self.capacity
+
+
+@dataclass(frozen=True)
+class BucketConfig:
+    burst: float  # 桶容量，即最多可以连续请求几次
+    rate: float  # 每秒补充的令牌数
+
+    def __post_init__(self) -> None:
+        # 每次请求消耗1个令牌，容量小于1的桶永远取不到令牌，wait模式下会一直等下去
+        if self.burst < 1:
+            raise ValueError(f'Rate limit burst must be at least 1, got {self.burst}')
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> BucketConfig:
+        return cls(burst=float(config['burst']), rate=float(config['rate']))
+
+
+class RateLimiter:
+    '''
+    按维度（群、用户、服务商）分别维护令牌桶
+    一次请求需要所有相关的桶都有令牌才放行，放行时各扣一个令牌
+    wait为True时，被限流的请求会排队等待（最多max_wait秒），否则立即抛出RateLimitExceeded
+    '''
+    MAX_BUCKETS = 4096
+
+    def __init__(
+        self,
+        scopes: Mapping[str, BucketConfig],
+        wait: bool = False,
+        max_wait: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._scopes = dict(scopes)
+        self._buckets: dict[tuple[str, str], TokenBucket] = {}
+        self.wait = wait
+        self.max_wait = max_wait
+        self._clock = clock
+
+    def _bucket(self, scope: str, key: str) -> TokenBucket:
+        bucket = self._buckets.get((scope, key))
+        if bucket is not None:
+            return bucket
+        if len(self._buckets) >= self.MAX_BUCKETS:
+            # 已经补满的桶和新建的桶没有区别，可以直接丢掉
+            self._buckets = {k: b for k, b in self._buckets.items() if not b.full}
+        config = self._scopes[scope]
+        bucket = self._buckets[(scope, key)] = TokenBucket(config.burst, config.rate, self._clock)
+        return bucket
+
+    def check(self, **keys: str | None) -> RateLimitExceeded | None:
+        '''
+        尝试取令牌，成功返回None，失败返回等待最久的那个维度的RateLimitExceeded（不扣令牌）
+        值为None的维度与未配置的维度不做限制
+        '''
+        now = self._clock()
+        buckets: list[TokenBucket] = []
+        worst: RateLimitExceeded | None = None
+        for scope, key in keys.items():
+            if key is None or scope not in self._scopes:
+                continue
+            bucket = self._bucket(scope, key)
+            buckets.append(bucket)
+            retry_after = bucket.retry_after(now=now)
+            if retry_after > 0 and (worst is None or retry_after > worst.retry_after):
+                worst = RateLimitExceeded(scope, key, retry_after)
+        if worst is not None:
+            return worst
+        for bucket in buckets:
+            bucket.take()
+        return None
+
+    async def acquire(self, **keys: str | None) -> None:
+        waited = 0.0
+        while True:
+            limited = self.check(**keys)
+            if limited is None:
+                return
+            if not self.wait or waited + limited.retry_after > self.max_wait:
+                raise limited
+            await asyncio.sleep(limited.retry_after)
+            waited += limited.retry_after
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any], defaults: Mapping[str, BucketConfig] | None = None) -> RateLimiter:
+        '''
+        config形如：
+        ```yaml
+        wait: false
+        max_wait: 30
+        group: {burst: 3, rate: 0.05}
+        user: {burst: 2, rate: 0.02}
+        provider: {burst: 1, rate: 0.5}
+        ```
+        '''
+        scopes = dict(defaults or {})
+        for scope in ('group', 'user', 'provider'):
+            if scope in config:
+                scopes[scope] = BucketConfig.from_config(config[scope])
+        return cls(scopes, wait=config.get('wait', False), max_wait=config.get('max_wait', 30.0))
@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from enum import IntEnum
+from inspect import isasyncgenfunction
+from typing import Any, AsyncIterator, Callable
+
+import time
+
+
+class Cost(IntEnum):
+    '''
+    被动反应的开销等级，便宜的先执行
+    '''
+    CHEAP = 0  # 只看最近几条聊天记录之类
+    MODERATE = 1  # 需要拼音等预处理
+    EXPENSIVE = 2  # 可能调用ai接口
+
+
+@dataclass(frozen=True)
+class ReactionSpec:
+    inputs: tuple[str, ...] = ()
+    cost: Cost = Cost.CHEAP
+    priority: int = 0  # 同一开销等级内，priority越大越先执行
+
+
+def reaction(*inputs: str, cost: Cost = Cost.CHEAP, priority: int = 0):
+    '''
+    把插件方法标记为被动反应，inputs为需要的输入名，执行时作为关键字参数传入：
+    ```python
+    @reaction('streak', cost=Cost.CHEAP)
+    def repeat(self, event, streak):
+        ...
+    ```
+    被动反应是生成器，yield出任何内容就视为触发，后面的被动反应不再执行
+    '''
+    def decorator[F: Callable](func: F) -> F:
+        func.__reaction__ = ReactionSpec(inputs, cost, priority)  # type: ignore[attr-defined]
+        return func
+    return decorator
+
+
+def reaction_input(name: str):
+    '''
+    把插件方法标记为被动反应的输入，方法签名为(self, event)
+    同一个事件中每个输入最多计算一次
+    '''
+    def decorator[F: Callable](func: F) -> F:
+        func.__reaction_input__ = name  # type: ignore[attr-defined]
+        return func
+    return decorator
+
+
+@dataclass
+class ReactionRule:
+    name: str
+    func: Callable[..., Any]
+    spec: ReactionSpec
+    calls: int = 0
+    hits: int = 0
+    elapsed: float = 0.0  # 累计判断耗时（不包括发送消息的时间）
+
+    def __repr__(self) -> str:
+        mean = self.elapsed / self.calls * 1000 if self.calls else 0.0
+        return f'{self.name}(hits={self.hits}/{self.calls}, mean={mean:.2f}ms)'
+
+
+@dataclass
+class _Inputs:
+    '''
+    单个事件的输入，按需计算并缓存
+    '''
+    event: Any
+    providers: dict[str, Callable[[Any], Any]]
+    values: dict[str, Any] = field(default_factory=dict)
+
+    def __getitem__(self, name: str) -> Any:
+        if name not in self.values:
+            self.values[name] = self.providers[name](self.event)
+        return self.values[name]
+
+
+class ReactionEngine:
+    '''
+    收集对象上被@reaction与@reaction_input标记的方法
+    按(开销等级, -priority)排序依次执行，第一个触发的被动反应之后全部跳过
+    '''
+    def __init__(self, owner: object) -> None:
+        self.rules: list[ReactionRule] = []
+        self.providers: dict[str, Callable[[Any], Any]] = {}
+        for attr in dir(type(owner)):
+            func = getattr(type(owner), attr, None)
+            if func is None:
+                continue
+            if (spec := getattr(func, '__reaction__', None)) is not None:
+                self.rules.append(ReactionRule(attr, getattr(owner, attr), spec))
+            if (name := getattr(func, '__reaction_input__', None)) is not None:
+                self.providers[name] = getattr(owner, attr)
+        for rule in self.rules:
+            missing = set(rule.spec.inputs) - self.providers.keys()
+            if missing:
+                raise ValueError(f"Reaction '{rule.name}' requires unknown inputs: {missing}")
+        self.rules.sort(key=lambda rule: (rule.spec.cost, -rule.spec.priority))
+
+    async def run(self, event: Any) -> AsyncIterator[Any]:
+        inputs = _Inputs(event, self.providers)
+        for rule in self.rules:
+            rule.calls += 1
+            start = time.perf_counter()
+            kwargs = {name: inputs[name] for name in rule.spec.inputs}
+            fired = False
+            if isasyncgenfunction(rule.func):
+                async for item in rule.func(event, **kwargs):
+                    if not fired:
+                        rule.elapsed += time.perf_counter() - start
+                        fired = True
+                    yield item
+            else:
+                for item in rule.func(event, **kwargs):
+                    if not fired:
+                        rule.elapsed += time.perf_counter() - start
+                        fired = True
+                    yield item
+            if fired:
+                rule.hits += 1
+                return
+            rule.elapsed += time.perf_counter() - start
+
+    def stats(self) -> str:
+        return ', '.join(map(repr, self.rules))
@@ -0,0 +1,280 @@
+from __future__ import annotations
+
+from collections import deque
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Collection, Sequence
+
+from pypinyin import Style, lazy_pinyin
+from pypinyin.pinyin_dict import pinyin_dict
+from pypinyin.style import convert
+
+
+# 常用汉字所在的CJK基本区，启动时直接查表建好拼音表，其余字符走LRU
+_CJK_BASIC = range(0x4E00, 0xA000)
+_PINYIN_TABLE: dict[str, str] = {
+    chr(code): convert(readings.split(',')[0], Style.NORMAL, strict=True)
+    for code, readings in pinyin_dict.items()
+    if code in _CJK_BASIC
+}
+# 多音字的读音取决于词语（例如"长长"读chang而不是默认的zhang），不能只查单字表
+# 只记去掉声调后仍有多个读音的字
+_READINGS: dict[str, frozenset[str]] = {
+    chr(code): syllables
+    for code, readings in pinyin_dict.items()
+    if ',' in readings
+    and len(syllables := frozenset(convert(r, Style.NORMAL, strict=True) for r in readings.split(','))) > 1
+}
+
+
+@lru_cache(maxsize=4096)
+def _lookup(char: str) -> str | None:
+    readings = pinyin_dict.get(ord(char))
+    if readings is None:
+        return None
+    return convert(readings.split(',')[0], Style.NORMAL, strict=True)
+
+
+def char_pinyin(char: str) -> str | None:
+    '''
+    单个字符的不带声调拼音（取默认读音），不是汉字时返回None
+    '''
+    syllable = _PINYIN_TABLE.get(char)
+    if syllable is not None:
+        return syllable
+    return _lookup(char)
+
+
+@lru_cache(maxsize=4096)
+def _phrase_pinyin(run: str) -> tuple[str, ...] | None:
+    '''
+    用pypinyin的词组读音转换一段连续的汉字，结果与原文对不上时返回None
+    '''
+    syllables = lazy_pinyin(run, style=Style.NORMAL)
+    if len(syllables) != len(run):
+        return None
+    return tuple(syllables)
+
+
+def _apply_phrases(text: str, syllables: list[str | None], positions: Collection[int]) -> None:
+    '''
+    把包含positions中任一下标的连续汉字改为按词组确定的读音
+    '''
+    i = 0
+    while i < len(text):
+        if syllables[i] is None:
+            i += 1
+            continue
+        j = i
+        while j < len(text) and syllables[j] is not None:
+            j += 1
+        if any(i <= position < j for position in positions):
+            phrase = _phrase_pinyin(text[i:j])
+            if phrase is not None:
+                syllables[i:j] = phrase
+        i = j
+
+
+def to_pinyin(text: str, style: Style = Style.NORMAL) -> list[str | None]:
+    '''
+    逐字转换拼音，与原文一一对应，style只支持NORMAL与FIRST_LETTER
+    不含多音字的连续汉字直接查表，含多音字的交给pypinyin按词组确定读音
+    '''
+    syllables = [char_pinyin(char) for char in text]
+    _apply_phrases(text, syllables, [i for i, char in enumerate(text) if char in _READINGS])
+    if style == Style.FIRST_LETTER:
+        return [s[0] if s else None for s in syllables]
+    return syllables
+
+
+@dataclass(frozen=True, slots=True)
+class TriggerMatch:
+    name: str
+    start: int  # 在原文中的下标，左闭右开
+    end: int
+
+
+class _Automaton:
+    '''
+    以拼音音节为字母表的Aho-Corasick自动机，一次扫描找出所有模式串的所有出现位置
+    '''
+    def __init__(self) -> None:
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[list[tuple[str, int]]] = [[]]
+        self._built = True
+
+    def add(self, name: str, pattern: Sequence[str]) -> None:
+        state = 0
+        for symbol in pattern:
+            nxt = self._goto[state].get(symbol)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][symbol] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = nxt
+        self._output[state].append((name, len(pattern)))
+        self._built = False
+
+    def _next(self, state: int, symbol: str) -> int:
+        while state and symbol not in self._goto[state]:
+            state = self._fail[state]
+        return self._goto[state].get(symbol, 0)
+
+    def _build(self) -> None:
+        queue = deque(self._goto[0].values())
+        for state in queue:
+            self._fail[state] = 0
+        while queue:
+            state = queue.popleft()
+            for symbol, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and symbol not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(symbol, 0)
+                self._output[nxt] = self._output[nxt] + self._output[self._fail[nxt]]
+        self._built = True
+
+    def scan(self, symbols: Sequence[str | None]) -> list[TriggerMatch]:
+        if not self._built:
+            self._build()
+        matches: list[TriggerMatch] = []
+        state = 0
+        for i, symbol in enumerate(symbols):
+            if symbol is None:
+                # 非汉字会打断拼音序列
+                state = 0
+                continue
+            state = self._next(state, symbol)
+            for name, length in self._output[state]:
+                matches.append(TriggerMatch(name, i - length + 1, i + 1))
+        return matches
+
+    def candidates(self, options: Sequence[Collection[str]]) -> list[tuple[int, int]]:
+        '''
+        每个位置可以取options中的任一音节时，所有可能出现匹配的区间（左闭右开）
+        同时跟踪所有可能的状态，空集合打断序列
+        '''
+        if not self._built:
+            self._build()
+        windows: list[tuple[int, int]] = []
+        states = {0}
+        for i, symbols in enumerate(options):
+            if not symbols:
+                states = {0}
+                continue
+            states = {self._next(state, symbol) for state in states for symbol in symbols}
+            for state in states:
+                for _, length in self._output[state]:
+                    windows.append((i - length + 1, i + 1))
+        return windows
+
+
+class TriggerEngine:
+    '''
+    按拼音（或拼音首字母）匹配触发词，例如：
+    ```python
+    engine = TriggerEngine()
+    engine.add('heyiwei', 'he yi wei')
+    engine.add('caicaibei', 'c c b', Style.FIRST_LETTER)
+    engine.match('你这是何意味')  # [TriggerMatch(name='heyiwei', start=3, end=6)]
+    ```
+    每条消息只转换一次拼音，触发词再多也只扫描一遍
+    拼音先直接查表，只有按多音字的所有读音可能匹配上触发词的位置才交给pypinyin按词组确定读音
+    '''
+    STYLES = (Style.NORMAL, Style.FIRST_LETTER)
+
+    def __init__(self) -> None:
+        self._automata: dict[Style, _Automaton] = {}
+        self._alphabet: dict[Style, set[str]] = {}  # 各风格的触发词中出现过的音节（或首字母）
+        self._longest = 0
+        self._heteronyms: frozenset[str] | None = None
+        self._last: tuple[str, list[TriggerMatch]] | None = None
+
+    def add(self, name: str, pattern: str | Sequence[str], style: Style = Style.NORMAL) -> None:
+        '''
+        pattern为空格分隔的音节（或首字母），也可以直接给出音节序列
+        '''
+        if style not in self.STYLES:
+            raise ValueError(f'Unsupported pinyin style: {style}')
+        if isinstance(pattern, str):
+            pattern = pattern.split()
+        if not pattern:
+            raise ValueError(f'Empty trigger pattern: {name}')
+        pattern = [s.lower() for s in pattern]
+        self._automata.setdefault(style, _Automaton()).add(name, pattern)
+        self._alphabet.setdefault(style, set()).update(pattern)
+        self._longest = max(self._longest, len(pattern))
+        self._heteronyms = None
+        self._last = None
+
+    @property
+    def heteronyms(self) -> frozenset[str]:
+        '''
+        某个读音出现在触发词中的多音字，其余多音字无论读哪个音都不会改变匹配结果
+        '''
+        if self._heteronyms is None:
+            self._heteronyms = frozenset(
+                char for char, readings in _READINGS.items()
+                if any(
+                    self._symbol(reading, style) in alphabet
+                    for style, alphabet in self._alphabet.items()
+                    for reading in readings
+                )
+            )
+        return self._heteronyms
+
+    def match(self, text: str) -> list[TriggerMatch]:
+        '''
+        返回text中所有触发词的出现位置，按结束位置排序
+        同一条消息的多个被动回复会先后调用，这里记住上一次的结果避免重复转换
+        '''
+        if self._last is not None and self._last[0] == text:
+            return self._last[1]
+        matches: list[TriggerMatch] = []
+        syllables = [char_pinyin(char) for char in text] if self._automata else []
+        heteronyms = self.heteronyms
+        positions = [i for i, char in enumerate(text) if char in heteronyms]
+        if positions:
+            _apply_phrases(text, syllables, self._ambiguous(text, syllables, positions))
+        for style, automaton in self._automata.items():
+            matches.extend(automaton.scan([self._symbol(s, style) if s else None for s in syllables]))
+        matches.sort(key=lambda m: m.end)
+        self._last = (text, matches)
+        return matches
+
+    @staticmethod
+    def _symbol(syllable: str, style: Style) -> str:
+        return syllable[0] if style == Style.FIRST_LETTER else syllable
+
+    def _ambiguous(self, text: str, syllables: Sequence[str | None], positions: Sequence[int]) -> set[int]:
+        '''
+        按多音字的所有读音扫描它前后触发词长度以内的文字，返回落在可能匹配的区间内的多音字
+        '''
+        # 合并各多音字前后的扫描范围
+        spans: list[tuple[int, int]] = []
+        for i in positions:
+            start, end = max(0, i - self._longest + 1), min(len(text), i + self._longest)
+            if spans and start <= spans[-1][1]:
+                spans[-1] = (spans[-1][0], end)
+            else:
+                spans.append((start, end))
+        marked = set(positions)
+        ambiguous: set[int] = set()
+        for start, end in spans:
+            for style, automaton in self._automata.items():
+                options: list[set[str]] = []
+                for i in range(start, end):
+                    syllable = syllables[i]
+                    if i in marked:
+                        options.append({self._symbol(r, style) for r in _READINGS[text[i]]})
+                    elif syllable is None:
+                        options.append(set())
+                    else:
+                        options.append({self._symbol(syllable, style)})
+                for window_start, window_end in automaton.candidates(options):
+                    ambiguous.update(i for i in positions if start + window_start <= i < start + window_end)
+        return ambiguous
@@ -0,0 +1,61 @@
+'''
+与原来基于eval的EID解析器对比速度与结果：
+python -m tests.bench_luapy data/HirasawaBot/isaac [zh_cn] [collectibles]
+'''
+from pathlib import Path
+import sys
+import timeit
+
+from plugins.hirasawa_bot.isaac_utis import LuapyError, iter_luapy
+
+
+def parse_eid_eval(luapy_path: Path) -> dict[int, dict]:
+    # 原来的实现，仅用于对比
+    ans: dict[int, dict] = {}
+    with open(luapy_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    for line in content.split('\n'):
+        parts = line.split('--')
+        line = parts[0] if len(parts) == 1 else '--'.join(parts[:-1])
+        line = line.strip()
+        if line.endswith(','): line = line[:-1]
+        if line.startswith('['):
+            line = ('='.join(line.split('=')[1:])).strip()
+        elif not line.startswith('{'):
+            continue
+        try:
+            item = eval(f'[{line[1:-1]}]')
+            ans[int(item[0])] = {'id': item[0], 'name': item[1], 'desc': item[2]}
+        except:
+            continue
+    return ans
+
+
+def parse_eid_stream(luapy_path: Path) -> dict[int, dict]:
+    return {
+        int(item[0]): {'id': str(item[0]), 'name': item[1], 'desc': item[2]}
+        for _, item in iter_luapy(luapy_path, errors=[])
+        if len(item) >= 3 and str(item[0]).isdigit()
+    }
+
+
+if __name__ == '__main__':
+    isaac_root = Path(sys.argv[1])
+    lang = sys.argv[2] if len(sys.argv) > 2 else 'zh_cn'
+    item_type = sys.argv[3] if len(sys.argv) > 3 else 'collectibles'
+    luapy_path = isaac_root / 'eid' / lang / f'{item_type}.luapy'
+
+    number = 20
+    for name, func in (('eval', parse_eid_eval), ('tokenizer', parse_eid_stream)):
+        seconds = timeit.timeit(lambda: func(luapy_path), number=number) / number
+        print(f'{name:>10}: {seconds * 1000:.2f} ms per load')
+
+    old, new = parse_eid_eval(luapy_path), parse_eid_stream(luapy_path)
+    errors: list[LuapyError] = []
+    list(iter_luapy(luapy_path, errors))
+    print(f'entries: eval={len(old)}, tokenizer={len(new)}, malformed lines={len(errors)}')
+    for key in sorted(old.keys() | new.keys()):
+        if old.get(key) != new.get(key):
+            print(f'  differs at {key}: eval={old.get(key)} tokenizer={new.get(key)}')
+    for error in errors:
+        print(f'  {error}')
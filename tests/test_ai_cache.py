@@ -0,0 +1,131 @@
+import asyncio
+import inspect
+from pathlib import Path
+from types import SimpleNamespace
+
+from plugins.hirasawa_bot import HirasawaBot
+from plugins.hirasawa_bot.ai_utils import ResponseCache, SingleFlight
+from plugins.hirasawa_bot.bot_utils import load_prompts
+from plugins.hirasawa_bot.history_utils import ChatRecord, HistoryStore
+from plugins.hirasawa_bot.ratelimit_utils import BucketConfig, RateLimiter
+
+
+BOT_ID = '10000'
+GROUP_ID = '123456'
+OTHER_GROUP_ID = '654321'
+PROMPTS_ROOT = Path(__file__).parent.parent / 'data' / 'HirasawaBot' / 'prompts'
+
+
+class FakeAI:
+    model = 'fake'
+
+    def __init__(self, delay: float = 0.0) -> None:
+        self.calls = 0
+        self.delay = delay
+
+    async def __lshift__(self, content: dict) -> str:
+        self.calls += 1
+        call = self.calls
+        await asyncio.sleep(self.delay)
+        return f'回复{call}'
+
+
+def make_bot(client: FakeAI) -> HirasawaBot:
+    bot = HirasawaBot.__new__(HirasawaBot)
+    bot.BOT_ID = BOT_ID
+    bot.ADMIN_ID = '1'
+    bot.MAX_HISTORY = 100
+    bot.history = HistoryStore(bot.MAX_HISTORY, bot_id=BOT_ID)
+    bot.history[GROUP_ID].bootstrap([])
+    bot.history[OTHER_GROUP_ID].bootstrap([])
+    bot.archive = SimpleNamespace(append=lambda group_id, record: None)
+    bot.promts = load_prompts(PROMPTS_ROOT)
+    bot._token_budget = {}
+    bot._ai_client = client
+    bot._ai_stream = False
+    bot._ai_cache = ResponseCache()
+    bot._ai_inflight = SingleFlight()
+    bot._rate_limiter = RateLimiter({})
+    return bot
+
+
+def say(bot: HirasawaBot, message_id: str, sender_id: str, message: str, group_id: str = GROUP_ID) -> SimpleNamespace:
+    bot.record(group_id, ChatRecord(message_id, message, sender_id, sender_id, 1700000000))
+    return SimpleNamespace(group_id=group_id, message_id=message_id, sender=SimpleNamespace(user_id=sender_id))
+
+
+async def run_command(bot: HirasawaBot, command, event, *args) -> list:
+    # 跳过@hirasawa与指令注册，像OutboundQueue一样把yield出的消息记入聊天记录
+    sent = []
+    async for item in inspect.unwrap(command)(bot, event, *args):
+        sent.append(item)
+        say(bot, f'bot-{len(bot.history[event.group_id])}', BOT_ID, str(item), event.group_id)
+    return sent
+
+
+def test_repeated_command_hits_cache():
+    async def main():
+        client = FakeAI()
+        bot = make_bot(client)
+        for i in range(10):
+            say(bot, f'm{i}', str(100 + i % 3), f'第{i}条消息')
+        first = await run_command(bot, HirasawaBot.analyse_jokes, say(bot, 'c1', '100', '/xdjx 5'), 5)
+        # 第二次调用时聊天记录里多了第一次的指令、"少女解析笑点中…"与ai回复
+        second = await run_command(bot, HirasawaBot.analyse_jokes, say(bot, 'c2', '101', '/xdjx 5'), 5)
+        return client, first, second
+
+    client, first, second = asyncio.run(main())
+    assert client.calls == 1
+    assert first == second == ['少女解析笑点中…', '回复1']
+
+
+def test_new_message_misses_cache():
+    async def main():
+        client = FakeAI()
+        bot = make_bot(client)
+        for i in range(10):
+            say(bot, f'm{i}', str(100 + i % 3), f'第{i}条消息')
+        await run_command(bot, HirasawaBot.analyse_jokes, say(bot, 'c1', '100', '/xdjx 5'), 5)
+        say(bot, 'm10', '102', '新的消息')
+        await run_command(bot, HirasawaBot.analyse_jokes, say(bot, 'c2', '101', '/xdjx 5'), 5)
+        return client
+
+    assert asyncio.run(main()).calls == 2
+
+
+def test_concurrent_commands_share_one_call():
+    async def main():
+        client = FakeAI(delay=0.05)
+        bot = make_bot(client)
+        # 排队等待令牌期间到达的相同请求也要合并
+        bot._rate_limiter = RateLimiter({'group': BucketConfig(burst=1, rate=20)}, wait=True)
+        bot._rate_limiter.check(group=GROUP_ID)
+        for i in range(30):
+            say(bot, f'm{i}', str(20000 + i % 3), f'第{i}条消息')
+        return client, await asyncio.gather(
+            run_command(bot, HirasawaBot.mimic, say(bot, 'c1', '20000', '/mimic 20001'), '20001'),
+            run_command(bot, HirasawaBot.mimic, say(bot, 'c2', '20002', '/mimic 20001'), '20001'),
+        )
+
+    client, (first, second) = asyncio.run(main())
+    assert client.calls == 1
+    assert first[-1] == second[-1] == '回复1'
+
+
+def test_groups_do_not_share_results():
+    async def main():
+        client = FakeAI(delay=0.05)
+        bot = make_bot(client)
+        # 两个群最近都只有bot消息，没有可以区分的聊天记录
+        for group_id in (GROUP_ID, OTHER_GROUP_ID):
+            for i in range(3):
+                say(bot, f'{group_id}-bot{i}', BOT_ID, '少女解析笑点中…', group_id)
+        first, second = await asyncio.gather(
+            run_command(bot, HirasawaBot.analyse_jokes, say(bot, 'c1', '100', '/xdjx 5', GROUP_ID), 5),
+            run_command(bot, HirasawaBot.analyse_jokes, say(bot, 'c2', '100', '/xdjx 5', OTHER_GROUP_ID), 5),
+        )
+        return client, first, second
+
+    client, first, second = asyncio.run(main())
+    assert client.calls == 2
+    assert first[-1] != second[-1]
@@ -0,0 +1,104 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from plugins.hirasawa_bot.ai_utils import AIRouter, ProviderUnavailable
+
+
+def server_error() -> openai.APIStatusError:
+    request = httpx.Request('POST', 'https://example.com')
+    return openai.InternalServerError('boom', response=httpx.Response(500, request=request), body=None)
+
+
+class FakeClient:
+    def __init__(self, model: str, delay: float = 0.0, fail: bool = False, fail_after: int | None = None) -> None:
+        self.model = model
+        self.delay = delay
+        self.fail = fail
+        self.fail_after = fail_after  # 流式请求在第几段之后出错
+        self.calls = 0
+
+    async def __call__(self, messages, prompt='', index=0, **kwargs) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise server_error()
+        return self.model
+
+    async def stream(self, messages, prompt='', on_first_token=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise server_error()
+        if on_first_token is not None:
+            on_first_token(self.delay)
+        # 凑齐第一句话又花了一些时间，不应计入ttft
+        await asyncio.sleep(0.05)
+        for i in range(3):
+            if self.fail_after is not None and i >= self.fail_after:
+                raise server_error()
+            yield f'{self.model}{i}'
+
+
+def test_unsampled_provider_does_not_outrank_primary():
+    async def main():
+        primary, backup = FakeClient('primary', delay=0.01), FakeClient('backup')
+        router = AIRouter({'backup': backup, 'primary': primary}, primary='primary')  # type: ignore[dict-item]
+        return [await router(['hi']) for _ in range(3)]
+
+    assert asyncio.run(main()) == ['primary'] * 3
+
+
+def test_half_open_lets_exactly_one_probe_through():
+    async def main():
+        primary = FakeClient('primary', fail=True)
+        router = AIRouter({'primary': primary}, failure_threshold=1, cooldown=0.05)  # type: ignore[dict-item]
+        with pytest.raises(openai.APIStatusError):
+            await router(['hi'])
+        await asyncio.sleep(0.06)
+        primary.fail = False
+        primary.delay = 0.02
+        primary.calls = 0
+        # 熔断到期后同时到达的请求只有一个去试探，其余的在试探结果出来之前仍然跳过
+        results = await asyncio.gather(*(router(['hi']) for _ in range(5)), return_exceptions=True)
+        return primary.calls, results, await router(['hi'])
+
+    calls, results, after = asyncio.run(main())
+    assert calls == 1
+    assert results.count('primary') == 1
+    assert sum(isinstance(r, ProviderUnavailable) for r in results) == 4
+    assert after == 'primary'
+
+
+def test_failed_probe_reopens_circuit():
+    async def main():
+        primary = FakeClient('primary', fail=True)
+        router = AIRouter({'primary': primary}, failure_threshold=3, cooldown=0.05)  # type: ignore[dict-item]
+        for _ in range(3):
+            with pytest.raises(openai.APIStatusError):
+                await router(['hi'])
+        await asyncio.sleep(0.06)
+        with pytest.raises(openai.APIStatusError):
+            await router(['hi'])  # 试探失败
+        with pytest.raises(ProviderUnavailable):
+            await router(['hi'])
+
+    asyncio.run(main())
+
+
+def test_stream_ttft_and_mid_stream_failure():
+    async def main():
+        primary = FakeClient('primary', delay=0.01, fail_after=1)
+        router = AIRouter({'primary': primary}, failure_threshold=1, cooldown=60)  # type: ignore[dict-item]
+        chunks = []
+        with pytest.raises(openai.APIStatusError):
+            async for chunk in router.stream(['hi']):
+                chunks.append(chunk)
+        return router, chunks
+
+    router, chunks = asyncio.run(main())
+    assert chunks == ['primary0']
+    assert router.ttft[-1] == pytest.approx(0.01)
+    assert 'open' in router.stats()
@@ -0,0 +1,130 @@
+import asyncio
+from types import SimpleNamespace
+
+from ncatbot.core.event import Image, MessageArray, Text
+
+from plugins.hirasawa_bot.bot_utils import FLUSH, MessageEventDuck, OutboundQueue, hirasawa, plain_text
+
+
+class FakeApi:
+    def __init__(self, delays: dict[str, float] | None = None, fail: set[str] | None = None) -> None:
+        self.sent: list[tuple[float, str, str]] = []  # (发送时间, 群号, 文本)
+        self.delays = delays or {}
+        self.fail = fail or set()
+
+    async def send_group_msg(self, group_id: str, message: list) -> str:
+        await asyncio.sleep(self.delays.get(group_id, 0))
+        text = plain_text(MessageArray.from_list(message)) or '[non-text]'
+        if text in self.fail:
+            raise RuntimeError('send failed')
+        self.sent.append((asyncio.get_running_loop().time(), group_id, text))
+        return f'id-{len(self.sent)}'
+
+    send_private_msg = send_group_msg
+
+
+class FakePlugin:
+    def __init__(self, api: FakeApi) -> None:
+        self.api = api
+        self.on_sent: list[tuple[str, str]] = []
+
+    def __on_sent__(self, event, msg: MessageArray, message_id: str) -> None:
+        self.on_sent.append((event.group_id, message_id))
+
+
+def group(group_id: str) -> MessageEventDuck:
+    return MessageEventDuck('group', group_id, '1')
+
+
+def text(value: str) -> MessageArray:
+    return MessageArray(Text(text=value))
+
+
+def texts(api: FakeApi, group_id: str | None = None) -> list[str]:
+    return [t for _, g, t in api.sent if group_id is None or g == group_id]
+
+
+def test_coalesces_text_within_window():
+    async def main():
+        api = FakeApi()
+        plugin = FakePlugin(api)
+        queue = OutboundQueue(plugin, interval=0.01, window=0.05)  # type: ignore[arg-type]
+        futures = [queue.put(group('1'), text(t)) for t in ('a', 'b')]
+        await asyncio.sleep(0.02)
+        futures.append(queue.put(group('1'), text('c')))
+        ids = await asyncio.gather(*futures)
+        return api, plugin, ids
+
+    api, plugin, ids = asyncio.run(main())
+    assert texts(api) == ['a\nb\nc']
+    assert ids == ['id-1'] * 3
+    assert plugin.on_sent == [('1', 'id-1')]
+
+
+def test_non_text_and_max_length_break_coalescing():
+    async def main():
+        api = FakeApi()
+        queue = OutboundQueue(FakePlugin(api), interval=0, window=0.05, max_length=5)  # type: ignore[arg-type]
+        items = [text('ab'), text('cd'), text('ef'), MessageArray(Image(file='x.png')), text('gh')]
+        await asyncio.gather(*(queue.put(group('1'), item) for item in items))
+        return api
+
+    assert texts(asyncio.run(main())) == ['ab\ncd', 'ef', '[non-text]', 'gh']
+
+
+def test_keeps_order_and_interval_per_group():
+    async def main():
+        api = FakeApi()
+        queue = OutboundQueue(FakePlugin(api), interval=0.05, window=0, max_length=1)  # type: ignore[arg-type]
+        await asyncio.gather(*(queue.put(group('1'), text(str(i))) for i in range(4)))
+        return api
+
+    api = asyncio.run(main())
+    assert texts(api) == ['0', '1', '2', '3']
+    times = [t for t, _, _ in api.sent]
+    assert all(b - a >= 0.045 for a, b in zip(times, times[1:]))
+
+
+def test_groups_do_not_block_each_other():
+    async def main():
+        api = FakeApi(delays={'slow': 0.2})
+        queue = OutboundQueue(FakePlugin(api), interval=0, window=0, max_length=1)  # type: ignore[arg-type]
+        slow = queue.put(group('slow'), text('slow'))
+        fast = [queue.put(group('fast'), text(str(i))) for i in range(3)]
+        await asyncio.gather(*fast)
+        assert texts(api) == ['0', '1', '2']
+        assert queue.pending(group('slow')) == 0 and not slow.done()
+        await slow
+        return api
+
+    assert texts(asyncio.run(main())) == ['0', '1', '2', 'slow']
+
+
+def test_failed_send_resolves_with_empty_id():
+    async def main():
+        api = FakeApi(fail={'boom'})
+        queue = OutboundQueue(FakePlugin(api), interval=0, window=0, max_length=1)  # type: ignore[arg-type]
+        return await asyncio.gather(queue.put(group('1'), text('boom')), queue.put(group('1'), text('ok')))
+
+    assert asyncio.run(main()) == ['', 'id-1']
+
+
+def test_flush_waits_for_previous_messages():
+    async def main():
+        api = FakeApi(delays={'1': 0.05})
+        plugin = FakePlugin(api)
+        plugin.outbound = OutboundQueue(plugin, interval=0, window=0)  # type: ignore[attr-defined, arg-type]
+        seen: list[list[str]] = []
+
+        async def command(self, event):
+            yield '再见'
+            yield FLUSH
+            seen.append(texts(api))
+            yield '已退出'
+
+        await hirasawa(command)(plugin, group('1'))  # type: ignore[arg-type]
+        return api, seen
+
+    api, seen = asyncio.run(main())
+    assert seen == [['再见']]
+    assert texts(api) == ['再见', '已退出']
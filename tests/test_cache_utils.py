@@ -0,0 +1,94 @@
+import json
+import os
+import time
+from pathlib import Path
+
+from cache_utils import AlbumCache
+
+
+def make_album(root: Path, album_id: str, size: int, age: float = 0) -> None:
+    album = root / album_id
+    album.mkdir(parents=True)
+    (album / '001.jpg').write_bytes(b'x' * size)
+    mtime = time.time() - age
+    os.utime(album, (mtime, mtime))
+
+
+def saved_index(root: Path) -> dict:
+    return json.loads((root / AlbumCache.INDEX_NAME).read_text(encoding='utf-8'))
+
+
+def test_scans_existing_albums_when_index_is_missing(tmp_path: Path):
+    make_album(tmp_path, '1', 100)
+    make_album(tmp_path, '2', 50)
+    cache = AlbumCache(tmp_path, quota=1000)
+    assert cache.total() == 150
+    assert sorted(saved_index(tmp_path)) == ['1', '2']
+
+
+def test_evicts_least_recently_used_albums_and_their_zips(tmp_path: Path):
+    zip_root = tmp_path / '.zips'
+    make_album(tmp_path, 'old', 100)
+    make_album(tmp_path, 'new', 100)
+    make_album(zip_root, 'old', 10)
+    cache = AlbumCache(tmp_path, quota=150, zip_root=zip_root)
+    cache.touch('old')
+    time.sleep(0.01)
+    cache.touch('new')
+    make_album(tmp_path, 'newest', 10)
+    cache.touch('newest', measure=True)
+    assert cache.evict() == ['old']
+    assert not (tmp_path / 'old').exists() and not (zip_root / 'old').exists()
+    assert cache.total() == 110
+    assert sorted(saved_index(tmp_path)) == ['new', 'newest']
+
+
+def test_pinned_and_kept_albums_survive_eviction(tmp_path: Path):
+    for album_id in ('a', 'b', 'c'):
+        make_album(tmp_path, album_id, 100)
+    cache = AlbumCache(tmp_path, quota=0)
+    cache.pin('a')
+    cache.pin('a')
+    cache.unpin('a')  # pin可以嵌套，还剩一次
+    assert sorted(cache.evict(keep=['b'])) == ['c']
+    cache.unpin('a', delay=0.05)
+    assert cache.evict(keep=['b']) == []
+    time.sleep(0.1)
+    assert cache.evict(keep=['b']) == ['a']
+
+
+def test_reconcile_picks_up_unindexed_and_removed_albums(tmp_path: Path):
+    make_album(tmp_path, 'indexed', 100)
+    cache = AlbumCache(tmp_path, quota=150)
+    # 下载失败留下的目录不在索引里，清理时也要计入
+    make_album(tmp_path, 'partial', 100, age=3600)
+    assert cache.evict() == ['partial']
+    make_album(tmp_path, 'partial', 100, age=3600)
+    (tmp_path / 'indexed' / '001.jpg').unlink()
+    (tmp_path / 'indexed').rmdir()
+    assert cache.evict() == []
+    assert cache.total() == 100
+    assert list(saved_index(tmp_path)) == ['partial']
+
+
+def test_touch_is_written_in_batches(tmp_path: Path):
+    make_album(tmp_path, '1', 10)
+    cache = AlbumCache(tmp_path, quota=1000, save_interval=0.1)
+    before = saved_index(tmp_path)['1']['last_access']
+    for _ in range(5):
+        cache.touch('1')
+    assert saved_index(tmp_path)['1']['last_access'] == before
+    time.sleep(0.2)
+    assert saved_index(tmp_path)['1']['last_access'] > before
+    cache.touch('1')
+    cache.flush()
+    assert saved_index(tmp_path)['1']['last_access'] == cache._index['1']['last_access']
+
+
+def test_reloads_saved_index(tmp_path: Path):
+    make_album(tmp_path, '1', 10)
+    cache = AlbumCache(tmp_path, quota=1000)
+    make_album(tmp_path, '2', 20)
+    cache.touch('2', measure=True)
+    cache.flush()
+    assert AlbumCache(tmp_path, quota=1000).total() == 30
@@ -0,0 +1,22 @@
+import asyncio
+
+from command_executor import iter_async
+
+
+def test_iter_async_drives_async_generator():
+    closed = []
+
+    async def command():
+        try:
+            yield '开始'
+            await asyncio.sleep(0)
+            yield '完成'
+        finally:
+            closed.append(True)
+
+    assert list(iter_async(command())) == ['开始', '完成']
+    assert closed == [True]
+    # 提前停止时也执行finally
+    for item in iter_async(command()):
+        break
+    assert closed == [True, True]
@@ -0,0 +1,55 @@
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from cv_utils import iter_obfuscate_album, obfuscation, perturb
+from tests.bench_obfuscation import perturb_loop
+
+
+def changes(result: np.ndarray, img: np.ndarray) -> tuple[int, float]:
+    diff = np.abs(result.astype(np.int16) - img).sum(axis=2)
+    return int(np.count_nonzero(diff)), float(diff[diff > 0].mean())
+
+
+def test_perturb_matches_loop_statistically():
+    # 像素值在[32, 64)时原实现的uint8求和不会溢出，加噪声后也不会小于0，两者的分布应当一致
+    # （超出这个范围时原实现会回绕，新实现截断到[0, 255]）
+    img = np.random.default_rng(1).integers(32, 64, (240, 160, 3), dtype=np.uint8)
+    rng = np.random.default_rng(0)
+    loop = np.array([changes(perturb_loop(img), img) for _ in range(20)]).mean(axis=0)
+    vectorized = np.array([changes(perturb(img, rng), img) for _ in range(20)]).mean(axis=0)
+    assert abs(loop[0] - vectorized[0]) / loop[0] < 0.05
+    assert abs(loop[1] - vectorized[1]) / loop[1] < 0.1
+
+
+def test_perturb_does_not_wrap_around():
+    img = np.full((64, 64, 3), 250, dtype=np.uint8)
+    assert perturb(img, np.random.default_rng(0)).min() >= 225
+
+
+def test_obfuscation_is_deterministic_per_seed():
+    img = np.random.default_rng(1).integers(0, 256, (240, 160, 3), dtype=np.uint8)
+    out = obfuscation(img, 42)
+    assert out.shape == (300, 200, 3) and out.dtype == np.uint8
+    assert np.array_equal(out, obfuscation(img, 42))
+    assert not np.array_equal(out, obfuscation(img, 43))
+
+
+def test_album_pages_depend_only_on_seed_and_name(tmp_path: Path):
+    rng = np.random.default_rng(1)
+    sources = []
+    for name in ('001.png', '002.png', '003.png'):
+        cv2.imwrite(str(tmp_path / name), rng.integers(0, 256, (40, 30, 3), dtype=np.uint8))
+        sources.append(tmp_path / name)
+    (tmp_path / 'broken.png').write_bytes(b'not an image')
+    pages = [(src, tmp_path / f'a_{src.stem}.png') for src in sources + [tmp_path / 'broken.png']]
+    results = dict(iter_obfuscate_album(pages, seed=7, max_workers=2))
+    assert results == {0: True, 1: True, 2: True, 3: False}
+    # 顺序与数量不同也得到同样的结果
+    reordered = [(src, tmp_path / f'b_{src.stem}.png') for src in reversed(sources[1:])]
+    assert all(ok for _, ok in iter_obfuscate_album(reordered, seed=7, max_workers=1))
+    for src in sources[1:]:
+        first, second = cv2.imread(str(tmp_path / f'a_{src.stem}.png')), cv2.imread(str(tmp_path / f'b_{src.stem}.png'))
+        assert first is not None and second is not None
+        assert np.array_equal(first, second)
@@ -0,0 +1,26 @@
+from pathlib import Path
+
+import pytest
+
+from file_utils import atomic_write
+
+
+def test_atomic_write_replaces_on_success(tmp_path: Path):
+    path = tmp_path / 'sub' / 'data.json'
+    with atomic_write(path) as tmp:
+        tmp.write_text('new', encoding='utf-8')
+        assert not path.exists()
+    assert path.read_text(encoding='utf-8') == 'new'
+    assert list(path.parent.iterdir()) == [path]
+
+
+def test_atomic_write_keeps_old_file_on_error(tmp_path: Path):
+    path = tmp_path / 'card.png'
+    path.write_text('old', encoding='utf-8')
+    with pytest.raises(RuntimeError):
+        with atomic_write(path, suffix='.tmp.png') as tmp:
+            assert tmp.name.endswith('.tmp.png')
+            tmp.write_text('half', encoding='utf-8')
+            raise RuntimeError('disk full')
+    assert path.read_text(encoding='utf-8') == 'old'
+    assert list(tmp_path.iterdir()) == [path]
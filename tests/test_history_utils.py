@@ -0,0 +1,157 @@
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+
+from plugins.hirasawa_bot import HirasawaBot
+from plugins.hirasawa_bot.history_utils import ChatRecord, GroupHistory, HistoryArchive, Streak, compact_history, estimate_tokens
+
+
+BOT_ID = '10000'
+
+
+def record(index: int, sender_id: str, message: str, time: int = 1700000000) -> ChatRecord:
+    return ChatRecord(str(index), message, sender_id, f'用户{sender_id}', time)
+
+
+def chat(*lines: tuple[str, str]) -> list[ChatRecord]:
+    return [record(i, sender_id, message) for i, (sender_id, message) in enumerate(lines)]
+
+
+def test_compaction_drops_commands_and_their_output():
+    compacted = compact_history(chat(
+        ('1', '你好'),
+        ('2', '/xdjx 5'),
+        (BOT_ID, '少女解析笑点中…'),
+        (BOT_ID, '笑点在于……'),
+        ('1', '哈哈'),
+        (BOT_ID, '我也觉得'),
+    ), bot_id=BOT_ID)
+    assert compacted.lines == ['[刚刚] A: 你好', 'A: 哈哈', 'B: 我也觉得']
+    assert compacted.header == ['A=1(用户1)', f'B={BOT_ID}(用户{BOT_ID})']
+    assert not compacted.has_talked('2')
+
+
+def test_compaction_merges_repeats_and_skips_bot_echoes():
+    compacted = compact_history(chat(
+        ('1', '草'),
+        ('2', '草'),
+        ('1', '草'),
+        ('2', '别复读了'),
+        (BOT_ID, '草'),
+    ), bot_id=BOT_ID)
+    assert compacted.lines == ['[刚刚] A,B: 草 ×3', 'B: 别复读了']
+
+
+def test_compaction_marks_relative_time_and_truncates():
+    records = [record(0, '1', '早', 1700000000), record(1, '2', '啊' * 10, 1700003700)]
+    compacted = compact_history(records, bot_id=BOT_ID, max_message_length=4)
+    assert compacted.lines == ['[1小时前] A: 早', '[刚刚] B: 啊啊啊啊…']
+
+
+def test_compaction_keeps_newest_messages_within_budget():
+    records = [record(i, str(i % 5), f'第{i}条消息，' + '聊' * 20) for i in range(100)]
+    for budget in (50, 200, 1000):
+        compacted = compact_history(records, budget=budget, bot_id=BOT_ID)
+        assert 0 < len(compacted) < 100
+        assert compacted.tokens <= budget
+        assert compacted.lines[-1].endswith(records[-1].message)
+    assert len(compact_history(records, budget=10 ** 6, bot_id=BOT_ID)) == 100
+    assert len(compact_history(records, budget=0, bot_id=BOT_ID)) == 0
+
+
+def test_estimate_tokens():
+    assert estimate_tokens('') == 0
+    assert estimate_tokens('你好') == 2
+    assert estimate_tokens('hello world') == 3
+
+
+def test_streak_counts_repeats_and_breaks():
+    history = GroupHistory(10, bot_id=BOT_ID)
+    for i, (sender_id, message) in enumerate([('1', '草'), ('2', '草'), ('3', '草'), ('1', '好')]):
+        history.append(record(i, sender_id, message))
+    streak = history.streak
+    assert (streak.length, streak.broken_length, streak.breaker) == (1, 3, '1')
+    history.append(record(4, '2', '好'))
+    assert (streak.length, streak.broken_length) == (2, 3)
+
+
+def react(rule, streak: Streak, message: str) -> list:
+    # 插件方法只依赖streak_threshold，默认阈值都是3
+    plugin = SimpleNamespace(streak_threshold=lambda group_id, kind: 3)
+    event = SimpleNamespace(group_id='1', message_id='m', raw_message=message)
+    return list(rule(plugin, event, streak))
+
+
+def test_bot_joins_a_repeat_only_once():
+    history = GroupHistory(10, bot_id=BOT_ID)
+    replies = []
+    for i, (sender_id, message) in enumerate([('1', '草'), ('2', '草'), ('3', '草'), ('4', '草'), ('5', '草')]):
+        history.append(record(i, sender_id, message))
+        replies.append(react(HirasawaBot.repeat, history.streak, message))
+        if replies[-1]:
+            history.append(record(100 + i, BOT_ID, message))  # bot发出的复读也会记入聊天记录
+    # 第三条相同的消息时跟一次，之后同一次复读不再跟
+    assert replies == [[], [], ['草'], [], []]
+    # 换了新的复读后可以再跟
+    for i, sender_id in enumerate(('1', '2', '3')):
+        history.append(record(200 + i, sender_id, '好'))
+    assert react(HirasawaBot.repeat, history.streak, '好') == ['好']
+
+
+def test_breaking_a_formation_of_three():
+    history = GroupHistory(10, bot_id=BOT_ID)
+    for i, message in enumerate(['草', '草', '好']):
+        history.append(record(i, str(i), message))
+    assert react(HirasawaBot.formation, history.streak, '好') == []
+    history = GroupHistory(10, bot_id=BOT_ID)
+    for i, message in enumerate(['草', '草', '草', '好']):
+        history.append(record(i, str(i), message))
+    assert len(react(HirasawaBot.formation, history.streak, '好')) == 1
+    # 只在打断的那一条消息时触发
+    history.append(record(10, '9', '好'))
+    assert react(HirasawaBot.formation, history.streak, '好') == []
+
+
+def test_ring_buffer_keeps_newest_and_counts_total():
+    history = GroupHistory(3, bot_id=BOT_ID)
+    for i in range(5):
+        history.append(record(i, str(i % 2), f'消息{i}'))
+    history.append(record(4, '0', '消息4'))  # 与最后一条重复的消息不再追加
+    assert [r.message_id for r in history] == ['2', '3', '4']
+    assert history.total == 5
+    assert history.messages_since('1') == 1 and history.messages_since('9') is None
+    assert [r.message_id for r in history.tail(2)] == ['3', '4']
+    assert [r.message_id for r in history.tail(2, exclude='4')] == ['2', '3']
+    assert [r.message_id for r in history.tail(10, exclude='3')] == ['2', '4']
+
+
+def test_bootstrap_prepends_and_replays_streak():
+    history = GroupHistory(5, bot_id=BOT_ID)
+    history.append(record(3, '3', '草'))
+    history.bootstrap([record(0, '0', '好'), record(1, '1', '草'), record(2, '2', '草'), record(3, '3', '草')])
+    assert [r.message_id for r in history] == ['0', '1', '2', '3']
+    assert history.bootstrapped and history.total == 4
+    assert (history.streak.length, history.streak.broken_length) == (3, 1)
+    assert history.messages_since('0') == 3
+
+
+def test_archive_round_trip(tmp_path: Path):
+    async def main():
+        archive = HistoryArchive(tmp_path / 'history.sqlite3', batch_size=2, flush_interval=60)
+        for i in range(3):
+            archive.append('g1', record(i, str(i), f'消息{i}', 1700000000 + i))
+        archive.append('g2', record(0, '9', '别的群'))
+        archive.append('g1', record(0, '0', '消息0'))  # 重复的消息只保存一次
+        # 查询前会先写入还没落盘的记录
+        recent = await archive.recent('g1', 2)
+        groups = await archive.groups()
+        await archive.close()
+        reopened = HistoryArchive(tmp_path / 'history.sqlite3')
+        everything = await reopened.recent('g1', 10)
+        await reopened.close()
+        return recent, groups, everything
+
+    recent, groups, everything = asyncio.run(main())
+    assert [(r.message_id, r.message) for r in recent] == [('1', '消息1'), ('2', '消息2')]
+    assert sorted(groups) == ['g1', 'g2']
+    assert [r.message_id for r in everything] == ['0', '1', '2']
@@ -0,0 +1,68 @@
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from plugins.hirasawa_bot.isaac_utis import EIDCardRenderer, LuapyError, iter_luapy
+
+
+LUAPY = '''-- header
+EID.descriptions = {
+{"1", "悲伤洋葱", "↑ 射速+0.7#{{Collectible2}} 很好"}, -- comment
+[2] = {"2", "内眼", "三连发#{{Trinket1}}"},
+[3] = {
+  {
+}
+},
+{"4", "妈妈的菜刀", "--危险-- 道具"},
+{"5", bad
+'''
+
+
+def test_structural_lines_are_not_errors(tmp_path: Path):
+    path = tmp_path / 'collectibles.luapy'
+    path.write_text(LUAPY, encoding='utf-8')
+    errors: list[LuapyError] = []
+    entries = list(iter_luapy(path, errors))
+    assert [fields[0] for _, fields in entries] == ['1', '2', '4']
+    assert entries[2][1][2] == '--危险-- 道具'
+    assert [error.lineno for error in errors] == [10]
+
+
+def make_item_image(path: Path) -> Path:
+    image = np.zeros((32, 32, 4), dtype=np.uint8)
+    image[8:24, 8:24] = (0, 0, 255, 255)
+    cv2.imwrite(str(path), image)
+    return path
+
+
+def test_card_renders_and_is_cached(tmp_path: Path):
+    renderer = EIDCardRenderer(tmp_path / 'cards', width=320, font_size=16)
+    item = make_item_image(tmp_path / 'collectible_001_sadonion.png')
+    segments = [item, 'Sad Onion\nid: 1\n', item, ' Tears up +0.7']
+    card = renderer.render(segments, 'collectibles_1_en_us_d')
+    assert card is not None and card.exists()
+    image = cv2.imread(str(card))
+    assert image.shape[1] == 320
+    # 有文字的地方不全是背景色
+    assert (image != EIDCardRenderer.BACKGROUND).any(axis=2).sum() > 500
+    assert renderer.render(segments, 'collectibles_1_en_us_d') == card
+
+
+def test_card_pruning(tmp_path: Path):
+    renderer = EIDCardRenderer(tmp_path / 'cards', width=320, font_size=16, max_cards=2)
+    item = make_item_image(tmp_path / 'collectible_001_sadonion.png')
+    old = renderer.render([item, 'old text'], 'collectibles_1_en_us_d')
+    new = renderer.render([item, 'new text'], 'collectibles_1_en_us_d')
+    assert old is not None and new is not None
+    assert not old.exists() and new.exists()
+    renderer.render([item, 'two'], 'collectibles_2_en_us_d')
+    renderer.render([item, 'three'], 'collectibles_3_en_us_d')
+    assert sorted(path.name.split('_')[1] for path in (tmp_path / 'cards').glob('*.png')) == ['2', '3']
+
+
+def test_card_without_cjk_font(tmp_path: Path):
+    renderer = EIDCardRenderer(tmp_path / 'cards', width=320, font_size=16)
+    item = make_item_image(tmp_path / 'collectible_001_sadonion.png')
+    card = renderer.render([item, '悲伤洋葱'], 'collectibles_1_zh_cn_d')
+    assert (card is not None) == renderer._painter.cjk
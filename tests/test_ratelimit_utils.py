@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+from plugins.hirasawa_bot import ratelimit_utils
+from plugins.hirasawa_bot.ratelimit_utils import BucketConfig, RateLimitExceeded, RateLimiter, TokenBucket
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_bucket_refills_up_to_capacity():
+    clock = FakeClock()
+    bucket = TokenBucket(2, 0.5, clock)
+    bucket.take()
+    bucket.take()
+    assert bucket.retry_after() == pytest.approx(2.0)
+    clock.now += 1
+    assert bucket.retry_after() == pytest.approx(1.0)
+    clock.now += 1
+    assert bucket.retry_after() == 0
+    clock.now += 100
+    assert bucket.full and bucket.tokens == 2
+
+
+def test_zero_rate_never_refills():
+    bucket = TokenBucket(1, 0, FakeClock())
+    bucket.take()
+    assert bucket.retry_after() == float('inf')
+
+
+def test_burst_then_limited_by_slowest_scope():
+    clock = FakeClock()
+    limiter = RateLimiter({'group': BucketConfig(burst=3, rate=1), 'user': BucketConfig(burst=1, rate=0.1)}, clock=clock)
+    assert limiter.check(group='g', user='a') is None
+    limited = limiter.check(group='g', user='a')
+    assert isinstance(limited, RateLimitExceeded)
+    assert (limited.scope, limited.key, limited.retry_after) == ('user', 'a', pytest.approx(10))
+    # 被拒绝的请求不扣令牌，其他用户还能用完群的burst
+    assert limiter.check(group='g', user='b') is None
+    assert limiter.check(group='g', user='c') is None
+    limited = limiter.check(group='g', user='d')
+    assert limited is not None and limited.scope == 'group'
+    clock.now += 1
+    assert limiter.check(group='g', user='d') is None
+
+
+def test_unconfigured_and_none_scopes_are_unlimited():
+    limiter = RateLimiter({'group': BucketConfig(burst=1, rate=0)}, clock=FakeClock())
+    assert limiter.check(group=None, user='a', provider='p') is None
+    assert limiter.check(group=None) is None
+    assert limiter.check(group='g') is None
+    assert limiter.check(group='g') is not None
+
+
+def test_burst_must_be_at_least_one():
+    with pytest.raises(ValueError):
+        BucketConfig(burst=0.5, rate=1)
+
+
+def test_wait_mode_sleeps_until_refilled(monkeypatch: pytest.MonkeyPatch):
+    clock = FakeClock()
+    slept: list[float] = []
+
+    async def sleep(seconds: float) -> None:
+        slept.append(seconds)
+        clock.now += seconds
+
+    monkeypatch.setattr(ratelimit_utils.asyncio, 'sleep', sleep)
+    limiter = RateLimiter({'group': BucketConfig(burst=1, rate=0.5)}, wait=True, max_wait=3, clock=clock)
+
+    async def main():
+        await limiter.acquire(group='g')
+        await limiter.acquire(group='g')
+        clock.now += 1.5
+        with pytest.raises(RateLimitExceeded):
+            limiter.wait = False
+            await limiter.acquire(group='g')
+        limiter.wait = True
+        await limiter.acquire(group='g')
+        # 需要等待的时间超过max_wait时直接拒绝
+        limiter.max_wait = 1
+        with pytest.raises(RateLimitExceeded):
+            await limiter.acquire(group='g')
+
+    asyncio.run(main())
+    assert slept == [pytest.approx(2), pytest.approx(0.5)]
+
+
+def test_from_config_overrides_defaults():
+    limiter = RateLimiter.from_config(
+        {'wait': True, 'max_wait': 5, 'group': {'burst': 2, 'rate': 0.1}},
+        defaults={'group': BucketConfig(burst=9, rate=9), 'provider': BucketConfig(burst=1, rate=1)},
+    )
+    assert limiter.wait and limiter.max_wait == 5
+    assert limiter._scopes == {'group': BucketConfig(burst=2, rate=0.1), 'provider': BucketConfig(burst=1, rate=1)}
+    with pytest.raises(ValueError):
+        RateLimiter.from_config({'user': {'burst': 0, 'rate': 1}})
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from plugins.hirasawa_bot.reaction_utils import Cost, ReactionEngine, reaction, reaction_input
+
+
+class Plugin:
+    def __init__(self, fire: set[str]) -> None:
+        self.fire = fire  # 会触发的被动反应
+        self.order: list[str] = []
+        self.computed: list[str] = []
+
+    @reaction_input('text')
+    def _text(self, event: str) -> str:
+        self.computed.append('text')
+        return event.strip()
+
+    @reaction_input('length')
+    def _length(self, event: str) -> int:
+        self.computed.append('length')
+        return len(event)
+
+    def _visit(self, name: str):
+        self.order.append(name)
+        if name in self.fire:
+            yield name
+
+    @reaction('text', cost=Cost.EXPENSIVE)
+    def expensive(self, event: str, text: str):
+        yield from self._visit('expensive')
+
+    @reaction('text', 'length', cost=Cost.MODERATE)
+    async def moderate(self, event: str, text: str, length: int):
+        for item in self._visit('moderate'):
+            yield item
+
+    @reaction('text', cost=Cost.CHEAP)
+    def cheap(self, event: str, text: str):
+        yield from self._visit('cheap')
+
+    @reaction('text', cost=Cost.CHEAP, priority=1)
+    def urgent(self, event: str, text: str):
+        yield from self._visit('urgent')
+
+
+async def collect(engine: ReactionEngine, event: str) -> list:
+    return [item async for item in engine.run(event)]
+
+
+def test_rules_run_by_cost_then_priority():
+    plugin = Plugin(fire=set())
+    assert asyncio.run(collect(ReactionEngine(plugin), ' hi ')) == []
+    assert plugin.order == ['urgent', 'cheap', 'moderate', 'expensive']
+
+
+def test_inputs_are_computed_lazily_once_per_event():
+    plugin = Plugin(fire=set())
+    engine = ReactionEngine(plugin)
+    asyncio.run(collect(engine, 'a'))
+    assert sorted(plugin.computed) == ['length', 'text']
+    asyncio.run(collect(engine, 'b'))
+    assert sorted(plugin.computed) == ['length', 'length', 'text', 'text']
+    # 第一个被动反应就触发时，后面才用到的输入不会计算
+    plugin = Plugin(fire={'urgent'})
+    asyncio.run(collect(ReactionEngine(plugin), 'a'))
+    assert plugin.computed == ['text']
+
+
+def test_first_fired_rule_short_circuits():
+    plugin = Plugin(fire={'moderate', 'expensive'})
+    engine = ReactionEngine(plugin)
+    assert asyncio.run(collect(engine, 'a')) == ['moderate']
+    assert plugin.order == ['urgent', 'cheap', 'moderate']
+    rules = {rule.name: rule for rule in engine.rules}
+    assert (rules['moderate'].calls, rules['moderate'].hits) == (1, 1)
+    assert (rules['cheap'].calls, rules['cheap'].hits) == (1, 0)
+    assert rules['expensive'].calls == 0
+
+
+def test_unknown_input_is_rejected():
+    class Broken:
+        @reaction('missing')
+        def rule(self, event, missing):
+            yield missing
+
+    with pytest.raises(ValueError):
+        ReactionEngine(Broken())
@@ -0,0 +1,47 @@
+from pypinyin import Style, lazy_pinyin
+
+from plugins.hirasawa_bot.trigger_utils import TriggerEngine, _phrase_pinyin, to_pinyin
+
+
+def make_engine() -> TriggerEngine:
+    engine = TriggerEngine()
+    engine.add('heyiwei', 'he yi wei')
+    engine.add('caicaibei', 'c c b', Style.FIRST_LETTER)
+    return engine
+
+
+def test_heteronyms_follow_phrase_readings():
+    # 长的默认读音是zhang，在"长长"里读chang
+    assert to_pinyin('长长吧') == ['chang', 'chang', 'ba']
+    for text in ('长长吧', '重重吧', '行行好', '你这是何意味', '银行长城'):
+        assert to_pinyin(text) == lazy_pinyin(text)
+
+
+def test_non_chinese_characters_break_runs():
+    assert to_pinyin('长城abc长') == ['chang', 'cheng', None, None, None, 'zhang']
+
+
+def test_triggers_with_heteronyms():
+    engine = make_engine()
+    assert [m.name for m in engine.match('长长吧')] == ['caicaibei']
+    assert [m.name for m in engine.match('菜菜杯')] == ['caicaibei']
+    assert [m.name for m in engine.match('你这是何意味')] == ['heyiwei']
+    assert engine.match('行行好') == []
+
+
+def test_typical_message_skips_phrase_lookup():
+    engine = make_engine()
+    _phrase_pinyin.cache_clear()
+    # 的、了、行、长、和都是多音字，但附近没有可能匹配上的触发词
+    assert engine.match('我们今天的行程很长，吃了饭和大家一起去银行') == []
+    assert _phrase_pinyin.cache_info().misses == 0
+    # 只有可能匹配的位置才按词组确定读音
+    assert [m.name for m in engine.match('今天的菜长长吧')] == ['caicaibei']
+    assert _phrase_pinyin.cache_info().misses == 1
+
+
+def test_ambiguous_windows_use_phrase_readings():
+    engine = make_engine()
+    # 重的默认读音是zhong，在"重重"里读chong
+    assert [(m.name, m.start) for m in engine.match('重重包围')] == [('caicaibei', 0)]
+    assert [(m.name, m.start) for m in engine.match('你这是何意味，长城不倒')] == [('heyiwei', 3), ('caicaibei', 7)]
@@ -0,0 +1,74 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Sequence
+import shutil
+import time
+
+import pyzipper
+
+from file_utils import atomic_write
+
+
+# 本身已经压缩过的格式，再deflate几乎不会变小，直接存储
+STORED_SUFFIXES = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.zip', '.7z', '.rar', '.mp4'}
+CHUNK_SIZE = 1 << 20  # 每次读写1MB，内存占用与文件大小无关
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='zip')
+
+
+def build_aes_zip(
+    dst: Path,
+    files: Sequence[Path],
+    password: bytes,
+    progress: Callable[[int, int], None] | None = None,
+) -> Path:
+    '''
+    把files以AES加密打包到dst，压缩包内只保留文件名
+    已压缩的格式使用ZIP_STORED，其余使用ZIP_DEFLATED，文件按CHUNK_SIZE分块写入
+    先写入临时文件，完成后再改名，失败时不会留下不完整的压缩包
+    progress(已完成文件数, 文件总数)在每个文件写完后调用
+    '''
+    # 临时文件以.part结尾，进程被杀时残留的也会被remove_stale清理
+    with atomic_write(dst, suffix='.part') as tmp_path:
+        with pyzipper.AESZipFile(tmp_path, 'w', compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES) as zipf:
+            zipf.setpassword(password)
+            for done, file in enumerate(files, 1):
+                info = zipf.zipinfo_cls.from_file(file, file.name)
+                info.compress_type = pyzipper.ZIP_STORED if file.suffix.lower() in STORED_SUFFIXES else pyzipper.ZIP_DEFLATED
+                with open(file, 'rb') as src, zipf.open(info, 'w') as out:
+                    shutil.copyfileobj(src, out, CHUNK_SIZE)
+                if progress is not None:
+                    progress(done, len(files))
+    return dst
+
+
+def submit_aes_zip(
+    dst: Path,
+    files: Sequence[Path],
+    password: bytes,
+    progress: Callable[[int, int], None] | None = None,
+) -> Future[Path]:
+    '''
+    在工作线程中执行build_aes_zip，不阻塞调用方
+    '''
+    return _executor.submit(build_aes_zip, dst, files, password, progress)
+
+
+def remove_stale(root: Path, max_age: float) -> int:
+    '''
+    删除root下修改时间早于max_age秒之前的压缩包（包括未完成的.part文件），返回删除的个数
+    '''
+    if not root.is_dir():
+        return 0
+    deadline = time.time() - max_age
+    removed = 0
+    for path in root.rglob('*'):
+        if path.suffix not in ('.zip', '.part'):
+            continue
+        try:
+            if path.stat().st_mtime < deadline:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            continue
+    return removed